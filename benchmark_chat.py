@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# benchmark_chat.py
+# Mide cuánto de la latencia del chat se va en la propia terminal: lanza
+# mock_chat_server.py en otro proceso, conduce DeepSeekTerminal contra él y
+# mide por separado el parseo SSE, el coloreado y las escrituras a stdout.
+#
+#   python benchmark_chat.py --runs 5 --tokens 4000 --output bench.json
+#   python benchmark_chat.py --baseline bench.json   # compara con otra versión
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import httpx
+
+import consolaavanzadacon_deepseek as chat
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args, port):
+    # En otro proceso para que su CPU no se mezcle con la del cliente
+    command = [
+        sys.executable, os.path.join(HERE, "mock_chat_server.py"),
+        "--port", str(port),
+        "--tokens", str(args.tokens),
+        "--token-rate", str(args.token_rate),
+        "--chunk-size", str(args.chunk_size),
+        "--latency", str(args.latency),
+        "--seed", str(args.seed),
+    ]
+    if args.recording:
+        command += ["--replay", args.recording]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("El servidor mock no arrancó")
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "mean": statistics.fmean(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "min": ordered[0],
+        "max": ordered[-1],
+    }
+
+
+async def run_end_to_end(terminal, runs, trace_memory):
+    samples = []
+    sink = open(os.devnull, "w")
+    real_stdout = sys.stdout
+    # Una vuelta de calentamiento, 'runs' medidas y, con trace_memory, una vuelta
+    # más sólo para la memoria (tracemalloc frena y falsearía los tiempos)
+    memory_run = runs + 1 if trace_memory else None
+    try:
+        for i in range(runs + 2 if trace_memory else runs + 1):
+            terminal.conversation_id = ""
+            if i == memory_run:
+                tracemalloc.start()
+
+            cpu_start = time.process_time()
+            sys.stdout = sink
+            try:
+                await terminal.send_message("benchmark")
+            finally:
+                sys.stdout = real_stdout
+            cpu = time.process_time() - cpu_start
+            result = terminal.last_result
+
+            if i == memory_run:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                if samples:
+                    samples[-1]["peak_memory_bytes"] = peak
+                continue
+            if i == 0:
+                continue  # Calentamiento: conexión, imports perezosos, caches
+
+            samples.append({
+                "ttft": result.ttft,
+                "duration": result.duration,
+                "tokens": result.tokens,
+                "tokens_per_second": result.tokens_per_second,
+                "cpu_seconds": cpu,
+                "cpu_us_per_token": cpu / result.tokens * 1e6 if result.tokens else None,
+                # Tras el calentamiento cada petición debe reutilizar la conexión del pool
+                "new_connection": result.connect_time is not None,
+            })
+    finally:
+        sink.close()
+        await terminal.close_clients()
+    return samples
+
+
+def capture_stream(base_url):
+    # Bytes crudos de una respuesta completa, troceados como llegaron
+    chunks = []
+    url = chat.platform_url("deepseek", "chat_path")
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        with client.stream("POST", url, json={"messages": [], "stream": True}) as response:
+            for chunk in response.iter_bytes():
+                chunks.append(chunk)
+    return chunks
+
+
+def bench_sse(terminal, chunks, repeat):
+    total_bytes = sum(len(c) for c in chunks)
+    timings = []
+    tokens = []
+    for _ in range(repeat):
+        result = chat.StreamResult("deepseek", chat.MODEL)
+        started = time.perf_counter()
+        decoder = chat.SSEDecoder()
+        for chunk in chunks:
+            for event in decoder.feed(chunk):
+                if event.data != "[DONE]":
+                    content = terminal.process_event(event, result)
+                    if content:
+                        result.add(content)
+        decoder.flush()
+        timings.append(time.perf_counter() - started)
+        tokens = result.parts
+    best = min(timings)
+    return {
+        "seconds": best,
+        "us_per_token": best / len(tokens) * 1e6 if tokens else None,
+        "mb_per_second": total_bytes / best / 1e6 if best else None,
+    }, tokens
+
+
+def bench_highlight(terminal, tokens, repeat):
+    text = "".join(tokens)
+
+    full = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        terminal.highlight_code(text)
+        full.append(time.perf_counter() - started)
+
+    incremental = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        highlighter = chat.CodeHighlighter()
+        for token in tokens:
+            highlighter.feed(token)
+        highlighter.finish()
+        incremental.append(time.perf_counter() - started)
+
+    return {
+        "highlight_code_seconds": min(full),
+        "incremental_seconds": min(incremental),
+        "incremental_us_per_token": min(incremental) / len(tokens) * 1e6 if tokens else None,
+    }
+
+
+async def bench_stdout(tokens, repeat):
+    # Escrituras reales (con su syscall de flush) contra /dev/null
+    naive = []
+    framed = []
+    with open(os.devnull, "w") as sink:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for token in tokens:
+                sink.write(token)
+                sink.flush()
+            naive.append(time.perf_counter() - started)
+
+        for _ in range(repeat):
+            renderer = chat.StreamRenderer(stream=sink)
+            started = time.perf_counter()
+            for token in tokens:
+                renderer.write(token)
+            renderer.close()
+            framed.append(time.perf_counter() - started)
+
+    return {
+        "per_token_flush_seconds": min(naive),
+        "stream_renderer_seconds": min(framed),
+        "stream_renderer_us_per_token": min(framed) / len(tokens) * 1e6 if tokens else None,
+    }
+
+
+def print_report(report, baseline=None):
+    def line(name, path, unit, scale=1.0):
+        value = report
+        old = baseline
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+            old = old.get(key) if isinstance(old, dict) else None
+        if value is None:
+            return
+        text = f"  {name:<36}{value * scale:>12.3f} {unit}"
+        if isinstance(old, (int, float)) and old:
+            text += f"   ({(value - old) / old * 100:+.1f}% vs base)"
+        print(text)
+
+    print(f"\n📊 {chat.APP_NAME} {report['version']} - benchmark")
+    print("Extremo a extremo (mediana):")
+    line("TTFT", ["end_to_end", "ttft", "median"], "ms", 1000)
+    line("Tokens/s", ["end_to_end", "tokens_per_second", "median"], "tok/s")
+    line("CPU por token", ["end_to_end", "cpu_us_per_token", "median"], "µs")
+    line("Memoria pico (tracemalloc)", ["end_to_end", "peak_memory_bytes"], "MB", 1e-6)
+    print("Componentes:")
+    line("Parseo SSE por token", ["sse", "us_per_token"], "µs")
+    line("Parseo SSE", ["sse", "mb_per_second"], "MB/s")
+    line("highlight_code (respuesta completa)", ["highlight", "highlight_code_seconds"], "ms", 1000)
+    line("Coloreado incremental por token", ["highlight", "incremental_us_per_token"], "µs")
+    line("stdout: flush por token", ["stdout", "per_token_flush_seconds"], "ms", 1000)
+    line("stdout: StreamRenderer", ["stdout", "stream_renderer_seconds"], "ms", 1000)
+    
+    new_connections = report["end_to_end"].get("new_connections")
+    if new_connections:
+        print(f"\n⚠️ {new_connections} de {len(report['samples'])} peticiones abrieron una conexión "
+              f"nueva: el pool no reutiliza las conexiones")
+
+async def main(args):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    mock = start_mock(args, port)
+    try:
+        chat.use_base_url(base_url)
+        # La sesión del benchmark no debe pisar la del usuario
+        workdir = tempfile.mkdtemp(prefix="bench-chat-")
+        chat.SESSION_FILE = os.path.join(workdir, "chat_session.json")
+        chat.DATABASE_FILE = os.path.join(workdir, "chat_store.db")
+        chat.RESPONSE_CACHE_DIR = os.path.join(workdir, "response_cache")
+        chat.ATTACHMENT_CACHE_DIR = os.path.join(workdir, "attachment_cache")
+        terminal = chat.DeepSeekTerminal()
+        # El prompt es siempre el mismo: con la caché se mediría su reproducción, no el stream
+        terminal.response_cache.enabled = False
+
+        samples = await run_end_to_end(terminal, args.runs, not args.no_memory)
+        chunks = await asyncio.to_thread(capture_stream, base_url)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    sse, tokens = bench_sse(terminal, chunks, args.repeat)
+    report = {
+        "version": chat.APP_VERSION,
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "config": {
+            "runs": args.runs,
+            "tokens": args.tokens,
+            "token_rate": args.token_rate,
+            "chunk_size": args.chunk_size,
+            "latency": args.latency,
+            "recording": args.recording,
+        },
+        "end_to_end": {
+            key: summarize([s[key] for s in samples])
+            for key in ("ttft", "duration", "tokens_per_second", "cpu_seconds", "cpu_us_per_token")
+        },
+        "sse": sse,
+        "highlight": bench_highlight(terminal, tokens, args.repeat),
+        "stdout": await bench_stdout(tokens, args.repeat),
+        "samples": samples,
+    }
+    peaks = [s["peak_memory_bytes"] for s in samples if "peak_memory_bytes" in s]
+    report["end_to_end"]["peak_memory_bytes"] = peaks[0] if peaks else None
+    report["end_to_end"]["new_connections"] = sum(1 for s in samples if s["new_connection"])
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de streaming del chat")
+    parser.add_argument("--runs", type=int, default=5, help="Respuestas completas a medir")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones de cada micro-benchmark")
+    parser.add_argument("--tokens", type=int, default=4000, help="Tokens por respuesta sintética")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Tokens/s del servidor (0 = lo más rápido posible)")
+    parser.add_argument("--chunk-size", type=int, default=1, help="Tokens por evento SSE")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latencia del servidor hasta el primer byte")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--recording", metavar="FICHERO_SSE", help="Reproducir un stream grabado en lugar del sintético")
+    parser.add_argument("--no-memory", action="store_true", help="No medir memoria pico (tracemalloc)")
+    parser.add_argument("--output", metavar="JSON", help="Guardar los resultados en este fichero")
+    parser.add_argument("--baseline", metavar="JSON", help="Resultados previos con los que comparar")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Resultados guardados en {args.output}")
+    
+    # Código de salida 1 si las peticiones no comparten conexión (útil en CI)
+    sys.exit(1 if report["end_to_end"]["new_connections"] else 0)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# consola_cliente.py
+# Cliente mínimo del daemon de consolaavanzadacon_deepseek.py: sólo usa la
+# biblioteca estándar para arrancar en milisegundos y deja la sesión, los
+# pools HTTP y el coloreado al proceso que ya está caliente.
+#
+#   python consolaavanzadacon_deepseek.py --daemon &
+#   python consola_cliente.py "¿Qué es un socket Unix?"
+#   git diff | python consola_cliente.py -c "Revisa este diff"
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Debe coincidir con DAEMON_SOCKET de consolaavanzadacon_deepseek.py (importarlo costaría el arranque)
+DAEMON_SOCKET = os.environ.get(
+    "PAPIWEB_CHAT_SOCKET", os.path.join(tempfile.gettempdir(), f"papiweb-chat-{os.getuid()}.sock")
+)
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        print(f"❌ No hay daemon en {path}", file=sys.stderr)
+        print("   Inícialo con: python consolaavanzadacon_deepseek.py --daemon", file=sys.stderr)
+        sys.exit(2)
+    return sock
+
+
+def request(path, data):
+    # Envía la petición y va devolviendo cada línea NDJSON de la respuesta
+    sock = connect(path)
+    try:
+        sock.sendall(json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as stream:
+            for line in stream:
+                yield json.loads(line)
+    finally:
+        sock.close()
+
+
+def read_prompt(args):
+    prompt = " ".join(args.prompt)
+    if not sys.stdin.isatty():
+        # Texto por tubería: va delante de la pregunta
+        piped = sys.stdin.read()
+        prompt = f"{piped}\n\n{prompt}" if prompt else piped
+    return prompt.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cliente ligero del daemon de la terminal de chat")
+    parser.add_argument("prompt", nargs="*", help="Mensaje (también se lee de stdin)")
+    parser.add_argument("-c", "--continue", dest="resume", action="store_true",
+                        help="Continuar la última conversación en lugar de abrir una nueva")
+    parser.add_argument("-p", "--platform", help="Plataforma (por defecto la del daemon)")
+    parser.add_argument("-m", "--model", help="Modelo (por defecto el del daemon)")
+    parser.add_argument("-a", "--attach", action="append", default=[], metavar="ARCHIVO",
+                        help="Adjuntar un archivo (se puede repetir)")
+    parser.add_argument("--no-color", action="store_true", help="Sin colorear los bloques de código")
+    parser.add_argument("--stats", action="store_true", help="Mostrar tokens y tiempos al final")
+    parser.add_argument("--ping", action="store_true", help="Comprobar si el daemon está vivo")
+    parser.add_argument("--shutdown", action="store_true", help="Detener el daemon")
+    parser.add_argument("--socket", default=DAEMON_SOCKET, help="Socket Unix del daemon")
+    args = parser.parse_args()
+
+    if args.ping or args.shutdown:
+        for reply in request(args.socket, {"command": "ping" if args.ping else "shutdown"}):
+            print(json.dumps(reply, ensure_ascii=False))
+        return 0
+
+    prompt = read_prompt(args)
+    if not prompt:
+        parser.error("falta el mensaje")
+
+    for path in args.attach:
+        if not os.path.isfile(path):
+            print(f"❌ Archivo no encontrado: {path}", file=sys.stderr)
+            return 1
+
+    data = {
+        "command": "prompt",
+        "prompt": prompt,
+        "platform": args.platform,
+        "model": args.model,
+        "continue": args.resume,
+        # El daemon puede tener otro directorio de trabajo
+        "files": [os.path.abspath(path) for path in args.attach],
+        "color": not args.no_color and sys.stdout.isatty(),
+    }
+    status = 1
+    try:
+        for reply in request(args.socket, data):
+            if "delta" in reply:
+                sys.stdout.write(reply["delta"])
+                sys.stdout.flush()
+            elif reply.get("done"):
+                sys.stdout.write("\n")
+                if reply.get("error"):
+                    print(f"❌ {reply['error']}", file=sys.stderr)
+                else:
+                    status = 0
+                if args.stats and reply.get("tokens"):
+                    print(f"⏱️ {reply['tokens']} tokens, primer token {reply['ttft'] or 0:.2f}s, "
+                          f"total {reply['duration']:.2f}s", file=sys.stderr)
+            elif "error" in reply:
+                print(f"❌ {reply['error']}", file=sys.stderr)
+    except KeyboardInterrupt:
+        # Al cerrar el socket el daemon cancela la petición en curso
+        print("\n🔴 Generación interrumpida", file=sys.stderr)
+        return 130
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 # deepseek_terminal_advanced.py
 
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import argparse
+import signal
 import json
 import re
 import os
@@ -10,22 +11,77 @@ import time
 import sys
 import html
 import threading
-import queue
-import mimetypes
-import base64
+import atexit
+import tempfile
+import contextlib
+import functools
+import datetime
+from collections import namedtuple, OrderedDict, deque
+import sqlite3
+import hashlib
+import subprocess
+import shlex
+import glob
+import fnmatch
+import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from prompt_toolkit import prompt, HTML
-from prompt_toolkit.history import FileHistory
-from prompt_toolkit.styles import Style
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.application import run_in_terminal
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalFormatter
+# requests, httpx, prompt_toolkit, pygments, mimetypes y base64 se importan
+# donde se usan: juntos son la mayor parte del arranque y no todos los modos los
+# necesitan (ver --profile-startup y --check-startup)
 
 # Configuración
-SESSION_FILE = "chat_session.json"
+DATABASE_FILE = "chat_store.db"  # Credenciales, conversaciones, mensajes y tiempos (SQLite)
+SESSION_FILE = "chat_session.json"  # Formato antiguo; se importa una vez a DATABASE_FILE
 HISTORY_FILE = "chat_history.txt"
+HISTORY_MAX_ENTRIES = 5000  # Entradas del prompt que se conservan; el fichero se compacta al doble
+SESSION_FLUSH_DELAY = 2.0  # Segundos de calma antes de escribir la sesión a disco
+VALIDATION_TTL = 10 * 60  # Segundos durante los que una sesión validada no se vuelve a comprobar
+CSRF_TTL = 30 * 60  # Segundos que se reutiliza un token CSRF antes de pedir otro
+CSRF_READ_CHUNK = 8 * 1024  # Bytes de la página de inicio leídos por iteración
+CSRF_MAX_BYTES = 512 * 1024  # Se deja de buscar el token pasado este tamaño
+ATTACHMENT_CACHE_DIR = ".attachment_cache"  # Adjuntos ya codificados en base64
+ATTACHMENT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # Tope de la caché (LRU por bytes)
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024  # Múltiplo de 3: el base64 de cada bloque no lleva relleno
+SEARCH_RESULTS = 10  # Resultados que muestra /search
+MAX_RESPONSE_TOKENS = 4096  # max_tokens pedido en cada respuesta
+TEMPERATURE = 0.7
+RESPONSE_CACHE_DIR = ".response_cache"  # Respuestas ya recibidas para prompts repetidos
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Segundos que una respuesta cacheada sigue siendo válida
+ATTACH_WORKERS = 8  # Hilos que leen y codifican adjuntos en paralelo
+ATTACH_MAX_FILE_BYTES = 8 * 1024 * 1024  # Binarios más grandes se omiten al recorrer directorios o globs
+MAP_REDUCE_MAX_BYTES = 1024 * 1024 * 1024  # Tope de un fichero de texto procesado por fragmentos
+MAP_REDUCE_CONCURRENCY = 4  # Peticiones de fragmentos en vuelo a la vez
+MAP_PROMPT = (
+    "Este es el fragmento {part}/{parts} del archivo {file_name}. Extrae de forma concisa "
+    "todo lo que sea relevante para la petición del usuario, citando líneas o datos concretos. "
+    "Si no hay nada relevante responde sólo 'Nada relevante'.\n\n"
+    "Petición: {question}\n\n--- Fragmento ---\n{chunk}"
+)
+REDUCE_PROMPT = (
+    "Combina estas notas parciales en unas solas, sin repetir y sin perder datos relevantes "
+    "para la petición del usuario.\n\nPetición: {question}\n\n--- Notas ---\n{notes}"
+)
+FINAL_PROMPT = (
+    "{question}\n\n(El archivo {files} era demasiado grande para enviarlo entero; "
+    "estas son las notas extraídas de todos sus fragmentos)\n\n{notes}"
+)
+ATTACH_MAX_TOTAL_BYTES = 64 * 1024 * 1024  # Tope de bytes de un mismo /attach
+ATTACH_MAX_FILES = 1000  # Tope de ficheros de un mismo /attach
+ATTACH_IGNORE = (  # Además del .gitignore de cada directorio raíz; los logs no: son entrada de map-reduce
+    ".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".tox",
+    ".mypy_cache", ".pytest_cache", ".ruff_cache", ".idea", ".vscode", "dist", "build",
+    ".attachment_cache", ".response_cache", "*.pyc", "*.pyo", "*.so", "*.o", "*.a",
+    "*.dll", "*.exe", "*.class", "*.zip", "*.tar", "*.gz", "*.whl", "*.db", "*.db-*",
+    "*.sqlite", ".DS_Store",
+)
+BYTES_PER_TOKEN = 3  # Estimación conservadora para trocear adjuntos de texto
+DEFAULT_TOKEN_BUDGET = 16000  # Ventana de contexto para modelos no listados
+MODEL_TOKEN_BUDGETS = {
+    "deepseek-chat": 64000,
+    "deepseek-coder": 64000,
+}
 DEEPSEEK_URL = "https://chat.deepseek.com"
 CLAUDE_URL = "https://claude.ai"
 GEMINI_URL = "https://gemini.google.com"
@@ -33,6 +89,71 @@ CHATGPT_URL = "https://chat.openai.com"
 MODEL = "deepseek-chat"  # deepseek-coder para programación
 PLATFORM = "deepseek"  # puede ser 'deepseek', 'claude', 'gemini' o 'chatgpt'
 
+# Endpoints y datos de cada plataforma
+PLATFORMS = {
+    "deepseek": {
+        "name": "DeepSeek Chat",
+        "url": DEEPSEEK_URL,
+        "chat_path": "/api/v0/chat/completions",
+        "validate_path": "/api/v0/models",
+        "login_path": "/auth/signin",
+        "domain": ".deepseek.com",
+        "session_cookie": "session_token",
+        "models": list(MODEL_TOKEN_BUDGETS),  # Modelos que anuncia /v1/models
+        "color": "blue",
+    },
+    "claude": {
+        "name": "Claude.ai",
+        "url": CLAUDE_URL,
+        "chat_path": "/api/chat",
+        "validate_path": "/api/organizations",
+        "login_path": "/auth/signin",
+        "domain": ".claude.ai",
+        "session_cookie": "session_token",
+        "models": [MODEL],
+        "color": "yellow",
+    },
+    "gemini": {
+        "name": "Google Gemini",
+        "url": GEMINI_URL,
+        "chat_path": "/api/generate_content",
+        "validate_path": "/api/auth/session",
+        "login_path": "/auth/signin",
+        "domain": ".google.com",
+        "session_cookie": "session_token",
+        "models": [MODEL],
+        "color": "green",
+    },
+    "chatgpt": {
+        "name": "ChatGPT",
+        "url": CHATGPT_URL,
+        "chat_path": "/backend-api/conversation",
+        "validate_path": "/api/auth/session",
+        "login_path": "/auth/login",
+        "domain": ".openai.com",
+        "session_cookie": "__Secure-next-auth.session-token",
+        "models": [MODEL],
+        "color": "magenta",
+    },
+}
+COMPARE_PLATFORMS = ["deepseek", "claude", "gemini", "chatgpt"]  # Destinos de /compare
+BATCH_WORKERS = 4  # Prompts en vuelo a la vez en modo lote
+BATCH_RATE_LIMIT = 1.0  # Peticiones por segundo y plataforma en modo lote (0 = sin límite)
+HTTP_MAX_CONNECTIONS = 10  # Conexiones simultáneas por plataforma
+HTTP_MAX_KEEPALIVE = 5  # Conexiones que se mantienen abiertas para reutilizar
+RENDER_FRAME_INTERVAL = 0.016  # Como mucho un volcado de stdout cada 16 ms
+DAEMON_SOCKET = os.environ.get(  # Socket Unix del daemon (--daemon); consola_cliente.py usa el mismo
+    "PAPIWEB_CHAT_SOCKET", os.path.join(tempfile.gettempdir(), f"papiweb-chat-{os.getuid()}.sock")
+)
+DAEMON_WARM_LEXERS = ("python", "javascript", "bash", "json", "sql")  # Lexers que el daemon precarga
+API_HOST = "127.0.0.1"  # --serve sólo escucha en local: usa las sesiones del usuario
+API_PORT = 8808  # Puerto por defecto del proxy /v1/chat/completions
+API_MAX_BODY_BYTES = 32 * 1024 * 1024  # Tope del cuerpo de una petición al proxy
+STATS_RING_SIZE = 1000  # Peticiones recientes que /stats conserva en memoria
+STATS_EXPORT_FILE = "chat_stats.jsonl"  # Destino por defecto de /stats export (.prom = Prometheus)
+STATS_EXPORT_INTERVAL = 10.0  # Segundos mínimos entre reescrituras de --stats-export
+STATS_METRIC_PREFIX = "papiweb_chat"  # Prefijo de las métricas en formato Prometheus
+
 # Información de la aplicación
 APP_NAME = "Terminal Chat Multimodelo"
 APP_VERSION = "1.0"
@@ -40,8 +161,11 @@ APP_COMPANY = "Papiweb Desarrollos Informáticos"
 APP_YEAR = "2025"
 APP_SUPPORT = "soporte@papiweb.com"
 
-# Estilo para la terminal
-style = Style.from_dict({
+STARTUP_BUDGET_MS = 150  # Tope de --check-startup para importar este módulo en frío
+LAZY_MODULES = ("requests", "httpx", "prompt_toolkit", "pygments")  # No deben cargarse al importar
+
+# Estilo para la terminal (se convierte en Style al abrir el prompt)
+PROMPT_STYLE = {
     'prompt': 'ansicyan bold',
     'assistant': 'ansigreen',
     'user': 'ansiblue',
@@ -51,7 +175,7 @@ style = Style.from_dict({
     'code': 'ansicyan',
     'file': 'ansiyellow',
     'brand': 'ansiyellow bold',
-})
+}
 
 # Colores ANSI para formato
 COLORS = {
@@ -66,243 +190,2469 @@ COLORS = {
     'white': '\033[97m',
 }
 
+# Evento SSE completo: tipo, datos (líneas 'data:' unidas con '\n') e id
+SSEEvent = namedtuple('SSEEvent', ['event', 'data', 'id'])
+
+class SSEDecoder:
+    # Decodificador incremental de Server-Sent Events que trabaja sobre los
+    # bytes crudos del socket. Acumula en un único bytearray reutilizable y
+    # sólo decodifica a str los valores de los campos ya completos.
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.data_lines = []
+        self.event_type = ""
+        self.last_event_id = ""
+        self.retry = None
+
+    def feed(self, chunk):
+        events = []
+        buf = self.buffer
+        buf += chunk
+        start = 0
+        
+        while True:
+            # Sólo se busca el salto de línea en los bytes nuevos
+            end = buf.find(b"\n", self.scan_pos)
+            if end == -1:
+                break
+            
+            line_end = end
+            if line_end > start and buf[line_end - 1] == 13:  # '\r\n'
+                line_end -= 1
+            
+            event = self.process_line(buf, start, line_end)
+            if event:
+                events.append(event)
+            
+            start = end + 1
+            self.scan_pos = start
+        
+        if start:
+            del buf[:start]
+        self.scan_pos = len(buf)
+        return events
+
+    def flush(self):
+        # Fin del stream: despachar el último evento aunque falte la línea vacía
+        events = []
+        if self.buffer:
+            event = self.process_line(self.buffer, 0, len(self.buffer))
+            if event:
+                events.append(event)
+            self.buffer.clear()
+            self.scan_pos = 0
+        event = self.dispatch()
+        if event:
+            events.append(event)
+        return events
+
+    def dispatch(self):
+        event = None
+        if self.data_lines:
+            event = SSEEvent(self.event_type or "message", "\n".join(self.data_lines), self.last_event_id)
+        self.data_lines = []
+        self.event_type = ""
+        return event
+
+    def process_line(self, buf, start, end):
+        # Línea vacía: fin del evento
+        if start == end:
+            return self.dispatch()
+        
+        # Comentario / keep-alive (": ping")
+        if buf[start] == 58:
+            return None
+        
+        colon = buf.find(b":", start, end)
+        if colon == -1:
+            field = bytes(buf[start:end])
+            value = ""
+        else:
+            field = bytes(buf[start:colon])
+            value_start = colon + 1
+            if value_start < end and buf[value_start] == 32:
+                value_start += 1
+            value = buf[value_start:end].decode('utf-8', errors='replace')
+        
+        if field == b"data":
+            self.data_lines.append(value)
+        elif field == b"event":
+            self.event_type = value
+        elif field == b"id":
+            if "\0" not in value:
+                self.last_event_id = value
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+        return None
+
+def platform_url(platform, path_key):
+    info = PLATFORMS[platform]
+    return f"{info['url']}{info[path_key]}"
+
+CSRF_META_PATTERN = re.compile(rb"<meta\b[^>]*\bname\s*=\s*[\"']csrf-token[\"'][^>]*>", re.IGNORECASE)
+CSRF_CONTENT_PATTERN = re.compile(rb"\bcontent\s*=\s*[\"']([^\"']*)[\"']", re.IGNORECASE)
+
+def find_csrf_token(response):
+    # Lee la página por trozos y para en cuanto aparece <meta name="csrf-token">;
+    # las meta van en <head>, así que llegar a </head> sin verla es no encontrarla
+    buffer = b""
+    for chunk in response.iter_content(CSRF_READ_CHUNK):
+        scan_from = max(0, len(buffer) - 512)  # Una etiqueta puede quedar partida entre dos trozos
+        buffer += chunk
+        match = CSRF_META_PATTERN.search(buffer, scan_from)
+        if match:
+            content = CSRF_CONTENT_PATTERN.search(match.group(0))
+            return html.unescape(content.group(1).decode("utf-8", errors="replace")) if content else ""
+        if b"</head>" in buffer[scan_from:].lower() or len(buffer) >= CSRF_MAX_BYTES:
+            break
+    return ""
+
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+def estimate_tokens(text):
+    # Estimación local y rápida: cada trozo de hasta 4 caracteres de palabra o
+    # cada signo cuenta como un token, cerca de lo que dan los tokenizadores BPE
+    return len(TOKEN_PATTERN.findall(text))
+
+CODE_BLOCK_PATTERN = re.compile(r"```(\w*)\n(.*?)```", re.DOTALL)
+
+def split_code_blocks(text):
+    # Separa la prosa de los bloques de código para indexarlos en columnas distintas
+    code = [match.group(2) for match in CODE_BLOCK_PATTERN.finditer(text)]
+    return CODE_BLOCK_PATTERN.sub(" ", text), "\n".join(code)
+
+def load_ignore_patterns(root):
+    patterns = list(ATTACH_IGNORE)
+    gitignore = os.path.join(root, ".gitignore")
+    if os.path.isfile(gitignore):
+        with open(gitignore, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                # Las negaciones (!) no se soportan: se ignoran
+                if line and not line.startswith(("#", "!")):
+                    patterns.append(line.strip("/"))
+    return patterns
+
+def is_ignored(rel_path, patterns):
+    rel_path = rel_path.replace(os.sep, "/")
+    parts = rel_path.split("/")
+    for pattern in patterns:
+        if "/" in pattern:
+            if fnmatch.fnmatch(rel_path, pattern) or rel_path.startswith(pattern + "/"):
+                return True
+        elif any(fnmatch.fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+def is_text_file(path):
+    with open(path, "rb") as f:
+        return b"\0" not in f.read(8192)
+
+def read_text_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8", errors="replace")
+
+def collect_attach_files(spec):
+    # Expande rutas, directorios y globs (** incluido) a una lista de ficheros
+    # aplicando las reglas de ignorado y los topes de tamaño y número.
+    # Devuelve (ficheros, [(ruta, motivo), ...] de los omitidos).
+    if os.path.exists(spec.strip()):
+        targets = [spec.strip()]  # Ruta con espacios sin comillas
+    else:
+        try:
+            targets = shlex.split(spec)
+        except ValueError:
+            targets = spec.split()
+    
+    candidates = []
+    explicit = set()  # Rutas nombradas tal cual: sin tope por fichero
+    skipped = []
+    for target in targets:
+        target = os.path.expanduser(target)
+        matches = glob.glob(target, recursive=True) if glob.has_magic(target) else [target]
+        if not matches:
+            skipped.append((target, "no encontrado"))
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                patterns = load_ignore_patterns(match)
+                for dirpath, dirnames, filenames in os.walk(match):
+                    rel_dir = os.path.relpath(dirpath, match)
+                    # Podar aquí evita recorrer node_modules, .git, ...
+                    dirnames[:] = sorted(
+                        d for d in dirnames
+                        if not is_ignored(os.path.normpath(os.path.join(rel_dir, d)), patterns)
+                    )
+                    for name in sorted(filenames):
+                        if not is_ignored(os.path.normpath(os.path.join(rel_dir, name)), patterns):
+                            candidates.append(os.path.join(dirpath, name))
+            elif os.path.isfile(match):
+                if glob.has_magic(target) and is_ignored(match, ATTACH_IGNORE):
+                    continue
+                if not glob.has_magic(target):
+                    explicit.add(match)
+                candidates.append(match)
+            elif not glob.has_magic(target):
+                skipped.append((match, "no encontrado"))
+    
+    files = []
+    seen = set()
+    total = 0
+    for path in candidates:
+        real = os.path.realpath(path)
+        if real in seen:
+            continue
+        seen.add(real)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            skipped.append((path, "no se puede leer"))
+            continue
+        if path in explicit:
+            # El usuario lo pidió por su nombre: los binarios grandes van por el
+            # codificador en streaming y la caché de adjuntos
+            files.append(path)
+            total += size
+        elif size > ATTACH_MAX_FILE_BYTES:
+            # Los textos grandes no se envían enteros sino por fragmentos (map-reduce)
+            if size <= MAP_REDUCE_MAX_BYTES and is_text_file(path):
+                files.append(path)
+            else:
+                skipped.append((path, f"{size / 1024 / 1024:.1f} MiB, más de {ATTACH_MAX_FILE_BYTES // 1024 // 1024} MiB"))
+        elif len(files) >= ATTACH_MAX_FILES:
+            skipped.append((path, f"más de {ATTACH_MAX_FILES} ficheros"))
+        elif total + size > ATTACH_MAX_TOTAL_BYTES:
+            skipped.append((path, f"se superan {ATTACH_MAX_TOTAL_BYTES // 1024 // 1024} MiB en total"))
+        else:
+            files.append(path)
+            total += size
+    return files, skipped
+
+def percentile(values, fraction):
+    # Rango más cercano sobre los valores ordenados, como en benchmark_chat.py
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def context_budget(model):
+    return MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET) - MAX_RESPONSE_TOKENS
+
+def use_base_url(base_url):
+    # Redirige todas las plataformas a un mismo servidor (p.ej. mock_chat_server.py)
+    global DEEPSEEK_URL
+    base_url = base_url.rstrip('/')
+    DEEPSEEK_URL = base_url
+    for info in PLATFORMS.values():
+        info["url"] = base_url
+
+def import_times():
+    # Importa este módulo en un intérprete nuevo con -X importtime y devuelve
+    # (acumulado_us, propio_us, nombre) por módulo; el nombre conserva la sangría
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        if own.strip().isdigit():
+            rows.append((int(cumulative), int(own), name.rstrip()))
+    return module, rows
+
+def loaded_lazy_modules(rows):
+    return sorted({name.strip().split(".")[0] for _, _, name in rows} & set(LAZY_MODULES))
+
+def profile_startup(top=25):
+    module, rows = import_times()
+    total = next((c for c, _, name in rows if name.strip() == module), 0)
+    print(f"⏱️ Importar {module}: {total / 1000:.1f} ms (presupuesto {STARTUP_BUDGET_MS} ms)")
+    print(f"{'acumulado':>12} {'propio':>10}  módulo")
+    for cumulative, own, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>10.1f}ms {own / 1000:>8.1f}ms  {name}")
+    lazy = loaded_lazy_modules(rows)
+    if lazy:
+        print(f"⚠️ Se cargan al arrancar: {', '.join(lazy)}")
+
+def check_startup(budget_ms=STARTUP_BUDGET_MS, runs=5):
+    # Mejor de varias ejecuciones en frío; falla si se pasa del presupuesto o si
+    # alguno de LAZY_MODULES vuelve a importarse en la cabecera del módulo
+    best = None
+    lazy = []
+    for _ in range(runs):
+        module, rows = import_times()
+        total = next((c for c, _, name in rows if name.strip() == module), None)
+        if total is None:
+            print(f"❌ No se pudo importar {module}")
+            return 1
+        best = total if best is None else min(best, total)
+        lazy = loaded_lazy_modules(rows)
+    
+    ok = best / 1000 <= budget_ms and not lazy
+    print(f"{'✅' if ok else '❌'} Arranque: {best / 1000:.1f} ms (presupuesto {budget_ms:g} ms)")
+    if lazy:
+        print(f"❌ Módulos que deberían importarse perezosamente: {', '.join(lazy)}")
+    return 0 if ok else 1
+
+@functools.lru_cache(maxsize=64)
+def get_cached_lexer(language):
+    # Un lexer por lenguaje para toda la sesión; None si Pygments no lo conoce
+    if not language:
+        return None
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        return get_lexer_by_name(language, stripnl=False)
+    except ClassNotFound:
+        return None
+
+@functools.lru_cache(maxsize=1)
+def get_cached_formatter():
+    from pygments.formatters import TerminalFormatter
+    return TerminalFormatter()
+
+class CodeHighlighter:
+    # Máquina de estados de markdown para colorear mientras llega el stream.
+    # Fuera de un bloque el texto se emite en cuanto llega y sólo se retiene el
+    # comienzo de línea que aún podría ser una valla ```. Dentro de un bloque
+    # cada línea completa se colorea con el lexer del lenguaje y se emite; el
+    # lexer ve también las líneas anteriores para no perder el estado (cadenas
+    # y comentarios de varias líneas).
+    def __init__(self):
+        self.line = ""
+        self.emitted = 0
+        self.in_code = False
+        self.lexer = None
+        self.block = ""                     # código emitido desde el último punto seguro
+
+    def feed(self, text):
+        out = []
+        scan_from = len(self.line)
+        self.line += text
+        
+        while True:
+            nl = self.line.find("\n", scan_from)
+            if nl == -1:
+                break
+            line = self.line[:nl + 1]
+            self.line = self.line[nl + 1:]
+            out.append(self.process_line(line))
+            self.emitted = 0
+            scan_from = 0
+        
+        # Línea a medias: en texto normal se emite salvo que pueda ser una valla
+        if not self.in_code and not (self.emitted == 0 and self.may_be_fence(self.line)):
+            out.append(self.line[self.emitted:])
+            self.emitted = len(self.line)
+        return "".join(out)
+
+    def finish(self):
+        line, self.line = self.line, ""
+        emitted, self.emitted = self.emitted, 0
+        if not line:
+            return ""
+        if self.in_code and not self.is_fence(line):
+            return self.highlight_line(line).rstrip("\n")
+        if self.is_fence(line) and emitted == 0:
+            return self.paint_fence(line)
+        return line[emitted:]
+
+    def may_be_fence(self, line):
+        stripped = line.lstrip(" ")
+        if len(line) - len(stripped) > 3:
+            return False
+        return "```".startswith(stripped) or stripped.startswith("```")
+
+    def is_fence(self, line):
+        stripped = line.lstrip(" ")
+        return len(line) - len(stripped) <= 3 and stripped.startswith("```")
+
+    def process_line(self, line):
+        if self.in_code:
+            if self.is_fence(line):
+                self.in_code = False
+                self.lexer = None
+                self.block = ""
+                return self.paint_fence(line)
+            return self.highlight_line(line)
+        
+        if self.emitted == 0 and self.is_fence(line):
+            info = line.strip()[3:].split()
+            self.in_code = True
+            self.lexer = get_cached_lexer(info[0] if info else "")
+            self.block = ""
+            return self.paint_fence(line)
+        return line[self.emitted:]
+
+    def paint_fence(self, line):
+        ending = "\n" if line.endswith("\n") else ""
+        return f"{COLORS['cyan']}{line.rstrip(chr(10))}{COLORS['reset']}{ending}"
+
+    def highlight_line(self, line):
+        if self.lexer is None:
+            return self.paint_fence(line)
+        from pygments.token import Comment, String
+        # Se vuelve a lexar desde el último punto seguro del bloque y sólo se
+        # formatean los tokens de la línea nueva (recortando el que empiece en
+        # una línea anterior)
+        start = len(self.block)
+        self.block += line
+        tokens = []
+        for index, token_type, value in self.lexer.get_tokens_unprocessed(self.block):
+            if index + len(value) <= start:
+                continue
+            if index < start:
+                value = value[start - index:]
+            tokens.append((token_type, value))
+        # Una línea que empieza con código (no dentro de una cadena ni de un
+        # comentario) es un punto seguro: la siguiente se lexa desde aquí y el
+        # coste no crece con el tamaño del bloque
+        first = next((t for t, v in tokens if v.strip()), None)
+        if first is not None and first not in String and first not in Comment:
+            self.block = line
+        out = io.StringIO()
+        get_cached_formatter().format(tokens, out)
+        return out.getvalue()
+
+class StreamRenderer:
+    # Pinta el stream agrupando tokens por fotograma. Cada write() del productor
+    # despierta al renderer: si ya pasó un fotograma desde el último volcado se
+    # escribe en el acto; si no, se programa un único volcado para el final del
+    # fotograma. close() vuelca lo pendiente y cancela lo programado. Con un
+    # highlighter los bloques de código se colorean según van llegando.
+    def __init__(self, stream=None, interval=RENDER_FRAME_INTERVAL, highlighter=None):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.highlighter = highlighter
+        self.loop = asyncio.get_running_loop()
+        self.parts = []
+        self.handle = None
+        self.last_flush = 0.0
+
+    def write(self, text):
+        if self.highlighter:
+            text = self.highlighter.feed(text)
+        if not text:
+            return
+        
+        self.parts.append(text)
+        if self.handle:
+            return
+        
+        delay = self.last_flush + self.interval - time.monotonic()
+        if delay <= 0:
+            self.flush()
+        else:
+            self.handle = self.loop.call_later(delay, self.flush)
+
+    def flush(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        if self.parts:
+            self.stream.write("".join(self.parts))
+            self.parts.clear()
+            self.stream.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.highlighter:
+            tail = self.highlighter.finish()
+            if tail:
+                self.parts.append(tail)
+        self.flush()
+
+class BoundedHistoryMixin:
+    # Historial del prompt leído una sola vez y acotado a max_entries. Las
+    # entradas nuevas se añaden al final del fichero como en FileHistory y,
+    # cuando el fichero acumula el doble del máximo, se reescribe (temporal +
+    # rename) sólo con las más recientes. Se combina con FileHistory en
+    # bounded_file_history_class() para no importar prompt_toolkit al arrancar.
+    def __init__(self, filename, max_entries=HISTORY_MAX_ENTRIES):
+        super().__init__(filename)
+        self.max_entries = max_entries
+        self.file_entries = 0
+
+    def load_history_strings(self):
+        strings = deque(maxlen=self.max_entries)
+        count = 0
+        lines = []
+        if os.path.exists(self.filename):
+            with open(self.filename, "rb") as f:
+                for line_bytes in f:
+                    line = line_bytes.decode("utf-8", errors="replace")
+                    if line.startswith("+"):
+                        lines.append(line[1:])
+                    elif lines:
+                        strings.append("".join(lines)[:-1])
+                        count += 1
+                        lines = []
+                if lines:
+                    strings.append("".join(lines)[:-1])
+                    count += 1
+        
+        self.file_entries = count
+        if count > self.max_entries * 2:
+            self.compact(strings)
+        
+        # Las más recientes primero, como espera prompt_toolkit
+        return list(reversed(strings))
+
+    def store_string(self, string):
+        super().store_string(string)
+        self.file_entries += 1
+        
+        # append_string ya insertó la entrada al principio de la lista en memoria
+        del self._loaded_strings[self.max_entries:]
+        if self.file_entries > self.max_entries * 2:
+            self.compact(reversed(self._loaded_strings))
+
+    def compact(self, strings):
+        # 'strings' de la más antigua a la más reciente
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp_path = tempfile.mkstemp(prefix=".history-", suffix=".tmp", dir=directory)
+        count = 0
+        with os.fdopen(fd, "wb") as f:
+            stamp = datetime.datetime.now()
+            for string in strings:
+                f.write(f"\n# {stamp}\n".encode("utf-8"))
+                for line in string.split("\n"):
+                    f.write(f"+{line}\n".encode("utf-8"))
+                count += 1
+        os.replace(tmp_path, self.filename)
+        self.file_entries = count
+
+@functools.lru_cache(maxsize=1)
+def bounded_file_history_class():
+    from prompt_toolkit.history import FileHistory
+    return type("BoundedFileHistory", (BoundedHistoryMixin, FileHistory), {"__module__": __name__})
+
+class SessionWriter:
+    # Persistencia diferida (write-behind) de la sesión: cada cambio sólo marca
+    # la sesión como sucia; la escritura ocurre tras SESSION_FLUSH_DELAY segundos
+    # sin cambios, al terminar un stream o al salir. 'write' recibe la última
+    # instantánea de cada clave (p.ej. de cada plataforma) y la guarda en una
+    # transacción, sin dejar estados a medias.
+    def __init__(self, write, delay=SESSION_FLUSH_DELAY):
+        self.write = write
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+        self.paused_count = 0
+        atexit.register(self.flush)
+
+    def mark_dirty(self, data, key=None):
+        # Se copia ya para que el hilo del timer no lea un dict a medio cambiar
+        with self.lock:
+            self.pending[key] = dict(data)
+            if not self.paused_count:
+                self.schedule()
+
+    def schedule(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    @contextlib.contextmanager
+    def paused(self):
+        # Sin escrituras a disco mientras dure el bloque (p.ej. un stream)
+        with self.lock:
+            self.paused_count += 1
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.paused_count -= 1
+                if self.pending and not self.paused_count:
+                    self.schedule()
+
+    def flush(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, {}
+        for data in pending.values():
+            self.write(data)
+
+class DiskLRUCache:
+    # Directorio de ficheros identificados por clave con desalojo LRU según el
+    # total de bytes ocupados. El orden de uso se reconstruye con el mtime.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        
+        found = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # Devuelve la ruta si la entrada existe y la marca como usada
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        return path
+
+    def temp_file(self):
+        # Temporal en el mismo directorio para poder publicarlo con os.replace
+        return tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+
+    def commit(self, key, tmp_path):
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.path(key))
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.evict()
+        return self.path(key)
+
+    def remove(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path(key))
+
+    def clear(self):
+        for key in list(self.entries):
+            self.remove(key)
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path(key))
+
+class AttachmentCache:
+    # Codifica adjuntos a base64 por bloques directamente a disco. El resultado
+    # se indexa por (ruta, tamaño, mtime) -> sha256 del contenido, de modo que
+    # volver a adjuntar un fichero sin cambios no lo lee ni lo recodifica.
+    def __init__(self, directory=None, max_bytes=ATTACHMENT_CACHE_MAX_BYTES):
+        # Se resuelve aquí para que ATTACHMENT_CACHE_DIR pueda cambiarse antes (benchmark_chat.py)
+        self.store = DiskLRUCache(directory or ATTACHMENT_CACHE_DIR, max_bytes)
+        self.stat_index = {}
+        self.split_index = {}
+        self.digest_index = {}
+
+    def digest(self, file_path):
+        # sha256 del fichero completo sin codificarlo (adjuntos que no se envían enteros)
+        st = os.stat(file_path)
+        stat_key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+        digest = self.digest_index.get(stat_key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+            digest = self.digest_index[stat_key] = sha256.hexdigest()
+        return digest
+
+    def split(self, file_path, max_bytes):
+        # Rangos de bytes [inicio, fin) que cortan en fin de línea y no pasan de
+        # max_bytes (salvo una línea que sola ya los supere). None si es binario.
+        st = os.stat(file_path)
+        split_key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns, max_bytes)
+        if split_key in self.split_index:
+            return self.split_index[split_key]
+        
+        ranges = []
+        start = pos = 0
+        with open(file_path, "rb") as f:
+            if b"\0" in f.read(8192):
+                ranges = None
+            else:
+                f.seek(0)
+                for line in f:
+                    if pos > start and pos - start + len(line) > max_bytes:
+                        ranges.append((start, pos))
+                        start = pos
+                    pos += len(line)
+                ranges.append((start, pos))
+        self.split_index[split_key] = ranges
+        return ranges
+
+    def encode(self, file_path, start=0, end=None):
+        st = os.stat(file_path)
+        stat_key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns, start, end)
+        
+        digest = self.stat_index.get(stat_key)
+        if digest:
+            data_path = self.store.get(digest + ".b64")
+            if data_path:
+                return digest, data_path
+        
+        # Una sola pasada: hash del contenido y base64 hacia un temporal
+        import base64
+        sha256 = hashlib.sha256()
+        fd, tmp_path = self.store.temp_file()
+        try:
+            with open(file_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                src.seek(start)
+                remaining = None if end is None else end - start
+                while remaining is None or remaining > 0:
+                    chunk = src.read(ENCODE_CHUNK_SIZE if remaining is None else min(ENCODE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    sha256.update(chunk)
+                    dst.write(base64.b64encode(chunk))
+            digest = sha256.hexdigest()
+            
+            # Mismo contenido bajo otra ruta: se reutiliza la entrada existente
+            data_path = self.store.get(digest + ".b64")
+            if data_path:
+                os.unlink(tmp_path)
+            else:
+                data_path = self.store.commit(digest + ".b64", tmp_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+        
+        self.stat_index[stat_key] = digest
+        return digest, data_path
+
+class StreamResult:
+    # Texto, conversation_id y tiempos de una respuesta en streaming
+    def __init__(self, platform, model, conversation_id=""):
+        self.platform = platform
+        self.model = model
+        self.conversation_id = conversation_id
+        self.parts = []
+        self.error = None
+        self.cached = False
+        self.truncated = False              # cancelada antes de terminar
+        self.started = time.perf_counter()
+        self.first_byte_at = None           # cabeceras de la respuesta recibidas
+        self.first_token_at = None
+        self.finished_at = None
+        self.connect_time = None            # sólo si se abrió una conexión nueva
+        self.tls_time = None
+        self.bytes = 0                      # bytes del cuerpo tal como llegaron del socket
+        self.chunks = 0                     # lecturas del cuerpo
+        self.trace_marks = {}
+
+    async def trace(self, event, info):
+        # Extensión 'trace' de httpx: httpcore avisa del inicio y fin de cada
+        # fase. La resolución DNS ocurre dentro de connect_tcp y va incluida.
+        now = time.perf_counter()
+        name, _, stage = event.rpartition(".")
+        if stage == "started":
+            self.trace_marks[name] = now
+        elif stage == "complete":
+            started = self.trace_marks.get(name, now)
+            if name == "connection.connect_tcp":
+                self.connect_time = now - started
+            elif name == "connection.start_tls":
+                self.tls_time = now - started
+            elif name.endswith(".receive_response_headers"):
+                self.first_byte_at = now
+
+    def add(self, content):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.parts.append(content)
+
+    def finish(self):
+        if self.finished_at is None:
+            self.finished_at = time.perf_counter()
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    @property
+    def tokens(self):
+        return len(self.parts)
+
+    @property
+    def ttfb(self):
+        if self.first_byte_at is None:
+            return None
+        return self.first_byte_at - self.started
+
+    @property
+    def ttft(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.perf_counter()) - self.started
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token_at is None or self.tokens < 2:
+            return 0.0
+        elapsed = (self.finished_at or time.perf_counter()) - self.first_token_at
+        return (self.tokens - 1) / elapsed if elapsed > 0 else 0.0
+
+class RateLimiter:
+    # Reparte los turnos con un intervalo mínimo entre peticiones. No necesita
+    # lock: entre leer y reservar el turno no hay ningún await.
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class ResponseCache:
+    # Respuestas completas en disco indexadas por hash de (plataforma, modelo,
+    # temperatura, mensaje, hashes de los adjuntos, turnos previos enviados), con
+    # caducidad y LRU por bytes.
+    # Se guardan los tokens tal como llegaron para reproducirlos por el renderer.
+    def __init__(self, directory=None, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 ttl=RESPONSE_CACHE_TTL):
+        self.store = DiskLRUCache(directory or RESPONSE_CACHE_DIR, max_bytes)
+        self.ttl = ttl
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, platform, model, temperature, message, attachment_hashes, context=()):
+        # La misma pregunta en otra conversación no tiene la misma respuesta
+        material = json.dumps([platform, model, temperature, message, list(attachment_hashes), list(context)],
+                              ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = self.store.get(key + ".json")
+        entry = None
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                entry = None
+            if entry is None or time.time() - entry.get("created", 0) > self.ttl:
+                self.store.remove(key + ".json")
+                entry = None
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["tokens"]
+
+    def put(self, key, result):
+        fd, tmp_path = self.store.temp_file()
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "created": time.time(),
+                "platform": result.platform,
+                "model": result.model,
+                "tokens": result.parts,
+            }, f, ensure_ascii=False)
+        self.store.commit(key + ".json", tmp_path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.store.entries),
+            "bytes": self.store.total_bytes,
+        }
+
+class RequestStats:
+    # Métricas de cada petición al backend en un buffer circular en memoria:
+    # registrar es O(1) y los percentiles se calculan sólo al pedirlos. Los
+    # contadores y sumas acumulados no se pierden al rotar el buffer, que es lo
+    # que espera Prometheus de un summary.
+    TIME_FIELDS = ("connect", "tls", "ttfb", "ttft", "duration")
+    COUNT_FIELDS = ("tokens", "bytes", "chunks")
+    HELP = {
+        "connect": "Conexión TCP nueva, resolución DNS incluida",
+        "tls": "Negociación TLS de una conexión nueva",
+        "ttfb": "Hasta recibir las cabeceras de la respuesta",
+        "ttft": "Hasta el primer token",
+        "duration": "Duración total",
+        "tokens": "Tokens recibidos",
+        "bytes": "Bytes del cuerpo recibidos",
+        "chunks": "Lecturas del cuerpo",
+    }
+
+    def __init__(self, size=STATS_RING_SIZE):
+        self.samples = deque(maxlen=size)
+        self.requests = {}                  # (plataforma, modelo, estado) -> peticiones
+        self.totals = {}                    # (plataforma, modelo, campo) -> [n, suma]
+        self.export_path = None
+        self.last_export = 0.0
+
+    def record(self, result, status):
+        sample = {
+            "ts": time.time(),
+            "platform": result.platform,
+            "model": result.model,
+            "status": status,
+            "connect": result.connect_time,
+            "tls": result.tls_time,
+            "ttfb": result.ttfb,
+            "ttft": result.ttft,
+            "duration": result.duration,
+            "tokens": result.tokens,
+            "bytes": result.bytes,
+            "chunks": result.chunks,
+        }
+        self.samples.append(sample)
+        key = (result.platform, result.model, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        for field in self.TIME_FIELDS + self.COUNT_FIELDS:
+            if sample[field] is not None:
+                total = self.totals.setdefault((result.platform, result.model, field), [0, 0])
+                total[0] += 1
+                total[1] += sample[field]
+        
+        if self.export_path and time.monotonic() - self.last_export >= STATS_EXPORT_INTERVAL:
+            self.export()
+
+    def summary(self):
+        # p50 y p95 de cada campo por plataforma y modelo
+        groups = {}
+        for sample in self.samples:
+            groups.setdefault((sample['platform'], sample['model']), []).append(sample)
+        rows = []
+        for (platform, model), samples in sorted(groups.items()):
+            row = {"platform": platform, "model": model, "count": len(samples), "statuses": {}}
+            for sample in samples:
+                row['statuses'][sample['status']] = row['statuses'].get(sample['status'], 0) + 1
+            for field in self.TIME_FIELDS + self.COUNT_FIELDS:
+                values = [sample[field] for sample in samples if sample[field] is not None]
+                row[field] = (percentile(values, 0.5), percentile(values, 0.95), len(values))
+            rows.append(row)
+        return rows
+
+    def prometheus_lines(self):
+        def labels(**values):
+            escaped = (
+                f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                for name, value in values.items()
+            )
+            return "{" + ",".join(escaped) + "}"
+        
+        name = f"{STATS_METRIC_PREFIX}_requests_total"
+        lines = [f"# HELP {name} Peticiones al backend por plataforma, modelo y estado",
+                 f"# TYPE {name} counter"]
+        for (platform, model, status), count in sorted(self.requests.items()):
+            lines.append(f"{name}{labels(platform=platform, model=model, status=status)} {count}")
+        
+        rows = self.summary()
+        for field in self.TIME_FIELDS + self.COUNT_FIELDS:
+            name = f"{STATS_METRIC_PREFIX}_request_{field}"
+            if field in self.TIME_FIELDS:
+                name += "_seconds"
+            lines.append(f"# HELP {name} {self.HELP[field]} (cuantiles sobre las {self.samples.maxlen} últimas peticiones)")
+            lines.append(f"# TYPE {name} summary")
+            for row in rows:
+                p50, p95, _ = row[field]
+                for quantile, value in (("0.5", p50), ("0.95", p95)):
+                    if value is not None:
+                        lines.append(f"{name}{labels(platform=row['platform'], model=row['model'], quantile=quantile)} {value}")
+            for (platform, model, total_field), (count, total) in sorted(self.totals.items()):
+                if total_field == field:
+                    lines.append(f"{name}_sum{labels(platform=platform, model=model)} {total}")
+                    lines.append(f"{name}_count{labels(platform=platform, model=model)} {count}")
+        return lines
+
+    def export(self, path=None):
+        # JSON lines con las muestras del buffer, o textfile de Prometheus si la
+        # ruta acaba en .prom; temporal + rename para no dejar lecturas a medias
+        path = path or self.export_path
+        self.last_export = time.monotonic()
+        if path.endswith(".prom"):
+            content = "\n".join(self.prometheus_lines()) + "\n"
+        else:
+            content = "".join(json.dumps(sample) + "\n" for sample in self.samples)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".stats-", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return len(self.samples)
+
+class ChatStore:
+    # Base de datos SQLite en modo WAL con las credenciales por plataforma, las
+    # conversaciones, sus mensajes y los tiempos de cada petición. Cada cambio
+    # es una pequeña transacción: nunca se reescribe el fichero completo.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS credentials (
+            platform TEXT PRIMARY KEY,
+            cookies TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY,
+            platform TEXT NOT NULL,
+            model TEXT,
+            remote_id TEXT,
+            title TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            conversation_id INTEGER NOT NULL REFERENCES conversations (id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            truncated INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, id);
+        CREATE TABLE IF NOT EXISTS timings (
+            id INTEGER PRIMARY KEY,
+            conversation_id INTEGER REFERENCES conversations (id),
+            platform TEXT NOT NULL,
+            model TEXT,
+            ttft REAL,
+            duration REAL,
+            tokens INTEGER,
+            cached INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS timings_platform ON timings (platform, model, created_at);
+        CREATE TABLE IF NOT EXISTS validations (
+            platform TEXT PRIMARY KEY,
+            checked_at REAL NOT NULL
+        );
+    """
+    # Columnas añadidas a bases de datos creadas con versiones anteriores
+    # (tabla, columna, definición); el número aplicado se guarda en PRAGMA
+    # user_version y SCHEMA ya las incluye
+    MIGRATIONS = [
+        ("messages", "truncated", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+
+    def __init__(self, path=None):
+        # Se resuelve aquí para que DATABASE_FILE pueda cambiarse antes de crear la terminal
+        path = path or DATABASE_FILE
+        self.path = path
+        self.lock = threading.RLock()
+        is_new = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+        self.migrate()
+        self.search_enabled = self.create_search_index()
+        if is_new:
+            self.import_legacy_files()
+
+    def migrate(self):
+        # Idempotente y con el bloqueo de escritura tomado: otro proceso puede estar
+        # migrando la misma base de datos, o una ejecución anterior pudo cortarse
+        # entre crear el esquema y guardar la versión
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                version = self.db.execute("PRAGMA user_version").fetchone()[0]
+                for table, column, definition in self.MIGRATIONS[version:]:
+                    columns = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+                    if column not in columns:
+                        self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                self.db.execute(f"PRAGMA user_version = {len(self.MIGRATIONS)}")
+            except BaseException:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def create_search_index(self):
+        # Índice invertido FTS5 (rowid = messages.id) con la prosa y el código por
+        # separado; se alimenta en add_message, sin volver a leer el historial
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'message_search'"
+        ).fetchone()
+        if exists:
+            return True
+        try:
+            with self.lock, self.db:
+                self.db.execute(
+                    "CREATE VIRTUAL TABLE message_search USING fts5("
+                    "prose, code, tokenize = 'unicode61 remove_diacritics 2')"
+                )
+                # Mensajes guardados antes de que existiera el índice
+                for message_id, content in self.db.execute("SELECT id, content FROM messages").fetchall():
+                    prose, code = split_code_blocks(content)
+                    self.db.execute(
+                        "INSERT INTO message_search (rowid, prose, code) VALUES (?, ?, ?)",
+                        (message_id, prose, code)
+                    )
+        except sqlite3.OperationalError:
+            return False  # SQLite compilado sin FTS5
+        return True
+
+    def import_legacy_files(self):
+        # Migración única desde chat_session.json
+        if os.path.exists(SESSION_FILE):
+            try:
+                with open(SESSION_FILE, 'r') as f:
+                    legacy = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                legacy = {}
+            if legacy.get('cookies'):
+                # El formato antiguo sólo guardaba las cookies de DeepSeek
+                self.save_credentials("deepseek", legacy['cookies'])
+            if legacy.get('last_conversation'):
+                self.set_setting('last_conversation', legacy['last_conversation'])
+
+    def get_setting(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key, value):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO settings (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    def load_credentials(self):
+        with self.lock:
+            rows = self.db.execute("SELECT platform, cookies FROM credentials").fetchall()
+        return {platform: json.loads(cookies) for platform, cookies in rows}
+
+    def save_credentials(self, platform, cookies):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO credentials (platform, cookies, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (platform) DO UPDATE SET cookies = excluded.cookies, updated_at = excluded.updated_at",
+                (platform, json.dumps(cookies), time.time())
+            )
+
+    def save_session_data(self, data):
+        # Destino de SessionWriter: credenciales de una plataforma y la conversación activa
+        with self.lock, self.db:
+            self.save_credentials(data['platform'], data['cookies'])
+            self.set_setting('last_conversation', data['last_conversation'])
+
+    def validation_fresh(self, platform, ttl=VALIDATION_TTL):
+        with self.lock:
+            row = self.db.execute("SELECT checked_at FROM validations WHERE platform = ?", (platform,)).fetchone()
+        return bool(row) and time.time() - row[0] < ttl
+
+    def save_validation(self, platform):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO validations (platform, checked_at) VALUES (?, ?) "
+                "ON CONFLICT (platform) DO UPDATE SET checked_at = excluded.checked_at",
+                (platform, time.time())
+            )
+
+    def clear_validation(self, platform):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM validations WHERE platform = ?", (platform,))
+
+    def create_conversation(self, platform, model, title="", created_at=None):
+        created_at = created_at or time.time()
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO conversations (platform, model, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (platform, model, title, created_at, created_at)
+            )
+        return cursor.lastrowid
+
+    def add_message(self, conversation, role, content, remote_id="", created_at=None, truncated=False):
+        created_at = created_at or time.time()
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO messages (conversation_id, role, content, tokens, created_at, truncated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation, role, content, estimate_tokens(content), created_at, int(truncated))
+            )
+            if self.search_enabled:
+                prose, code = split_code_blocks(content)
+                self.db.execute(
+                    "INSERT INTO message_search (rowid, prose, code) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, prose, code)
+                )
+            self.db.execute(
+                "UPDATE conversations SET updated_at = ?, remote_id = COALESCE(NULLIF(?, ''), remote_id) WHERE id = ?",
+                (created_at, remote_id, conversation)
+            )
+        return cursor.lastrowid
+
+    def recent_messages(self, conversation, budget):
+        # Se recorren sólo (id, tokens) hacia atrás; el texto se lee al final
+        first_id = None
+        used = 0
+        with self.lock:
+            for message_id, tokens in self.db.execute(
+                "SELECT id, tokens FROM messages WHERE conversation_id = ? ORDER BY id DESC",
+                (conversation,)
+            ):
+                if used + tokens > budget:
+                    break
+                used += tokens
+                first_id = message_id
+            if first_id is None:
+                return []
+            rows = self.db.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? AND id >= ? ORDER BY id",
+                (conversation, first_id)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def list_conversations(self, limit=20):
+        with self.lock:
+            return self.db.execute(
+                "SELECT c.id, c.platform, c.model, c.title, c.updated_at, "
+                "(SELECT COUNT(*) FROM messages m WHERE m.conversation_id = c.id) "
+                "FROM conversations c ORDER BY c.updated_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def search(self, query, limit=SEARCH_RESULTS, mark=("", "")):
+        # Cada palabra se busca como prefijo; bm25 pesa más las coincidencias en código
+        terms = [term.replace('"', '""') for term in query.split()]
+        if not terms or not self.search_enabled:
+            return []
+        match = " ".join(f'"{term}"*' for term in terms)
+        with self.lock:
+            return self.db.execute(
+                "SELECT m.conversation_id, c.title, m.role, m.truncated, m.created_at, "
+                "snippet(message_search, -1, ?, ?, '…', 16) "
+                "FROM message_search "
+                "JOIN messages m ON m.id = message_search.rowid "
+                "JOIN conversations c ON c.id = m.conversation_id "
+                "WHERE message_search MATCH ? "
+                "ORDER BY bm25(message_search, 1.0, 2.0) LIMIT ?",
+                (mark[0], mark[1], match, limit)
+            ).fetchall()
+
+    def remote_id(self, conversation):
+        with self.lock:
+            row = self.db.execute("SELECT remote_id FROM conversations WHERE id = ?", (conversation,)).fetchone()
+        return (row[0] if row else None) or ""
+
+    def record_timing(self, conversation, result):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO timings (conversation_id, platform, model, ttft, duration, tokens, cached, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (conversation, result.platform, result.model, result.ttft, result.duration,
+                 result.tokens, int(result.cached), time.time())
+            )
+
+class ConversationStore:
+    # Conversación activa sobre ChatStore. La ventana de contexto se construye
+    # con los mensajes más recientes que quepan en el presupuesto de tokens;
+    # en memoria sólo se guarda el id de la conversación.
+    def __init__(self, store, setting='current_conversation'):
+        # setting: ajuste donde se recuerda la conversación activa entre
+        # reinicios (cada cliente usa el suyo); None para una conversación
+        # nueva que no se recuerda
+        self.store = store
+        self.setting = setting
+        conversation = store.get_setting(setting) if setting else None
+        self.conversation = int(conversation) if conversation else None
+
+    def reset(self):
+        self.conversation = None
+        if self.setting:
+            self.store.set_setting(self.setting, None)
+
+    def append(self, role, content, conversation_id="", truncated=False):
+        if self.conversation is None:
+            title = content.strip().splitlines()[0][:80] if content.strip() else ""
+            self.conversation = self.store.create_conversation(PLATFORM, MODEL, title)
+            if self.setting:
+                self.store.set_setting(self.setting, str(self.conversation))
+        return self.store.add_message(self.conversation, role, content, conversation_id, truncated=truncated)
+
+    def append_exchange(self, message, result):
+        # Pregunta y respuesta; la respuesta cortada a medias queda marcada como truncada
+        self.append("user", message, result.conversation_id)
+        return self.append("assistant", result.text, result.conversation_id, result.truncated)
+
+    def context_window(self, budget):
+        if self.conversation is None:
+            return []
+        return self.store.recent_messages(self.conversation, budget)
+
+class ChatHTTPError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Error HTTP {status_code}")
+        self.status_code = status_code
+        self.text = text
+
 class DeepSeekTerminal:
     def __init__(self):
-        self.session = requests.Session()
-        self.session_data = self.load_session()
-        self.conversation_id = self.session_data.get('last_conversation', "")
-        self.message_history = []
+        self._session = None
+        self.store = ChatStore()
+        self.session_writer = SessionWriter(self.store.save_session_data)
+        self.attachment_cache = AttachmentCache()
+        self.attach_executor = ThreadPoolExecutor(max_workers=ATTACH_WORKERS, thread_name_prefix="attach")
+        self.response_cache = ResponseCache()
+        self.request_stats = RequestStats()
+        self.files_to_attach = []
+        self.conversation_id = self.store.get_setting('last_conversation') or ""
+        self.history = ConversationStore(self.store)
         self.streaming_active = False
-        self.stop_stream = threading.Event()
-        self.stream_queue = queue.Queue()
-        self.key_bindings = self.create_key_bindings()
-        
-        # Configurar headers
-        self.session.headers.update({
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-            "Accept-Language": "es-ES,es;q=0.8,en-US;q=0.5,en;q=0.3",
-            "Referer": f"{DEEPSEEK_URL}/",
-        })
-        
-        # Configurar cookies existentes
-        for name, value in self.session_data.get('cookies', {}).items():
-            self.session.cookies.set(name, value, domain='.deepseek.com')
+        self.stream_task = None
+        self.stream_interrupted = False
+        self.last_result = None
+        self.clients = {}
+        self.interactive = True             # False en --daemon/--serve: nunca se pide nada por stdin
+        self.prompt_active = False          # prompt_toolkit es dueño de la terminal
+        self.login_locks = {}
+        self.login_count = {}
+    
+    @property
+    def session(self):
+        # requests es el import más caro: la sesión se crea con su primer uso
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+            
+            # Configurar headers
+            self._session.headers.update({
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+                "Accept-Language": "es-ES,es;q=0.8,en-US;q=0.5,en;q=0.3",
+                "Referer": f"{DEEPSEEK_URL}/",
+            })
+            
+            # Configurar cookies existentes de todas las plataformas
+            for platform, cookies in self.store.load_credentials().items():
+                if platform not in PLATFORMS:
+                    continue
+                for name, value in cookies.items():
+                    if value:
+                        self._session.cookies.set(name, value, domain=PLATFORMS[platform]['domain'])
+        return self._session
     
     def create_key_bindings(self):
+        from prompt_toolkit.key_binding import KeyBindings
         bindings = KeyBindings()
         
         @bindings.add('c-c')
         def _(event):
+            # El prompt sigue activo durante el stream: Ctrl+C corta la respuesta
+            # y deja escribir; sin stream en curso, descarta la línea
             if self.streaming_active:
-                self.stop_stream.set()
-                self.print_message("\n\n🔴 Generación interrumpida\n", 'warning')
-                event.app.exit()
+                self.cancel_stream()
             else:
                 event.app.exit(exception=KeyboardInterrupt, style='class:aborting')
         
         return bindings
     
-    def load_session(self):
-        if os.path.exists(SESSION_FILE):
-            try:
-                with open(SESSION_FILE, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                pass
-        return {"cookies": {}, "last_conversation": ""}
-    
-    def save_session(self):
-        cookies = {}
-        if PLATFORM == "chatgpt":
-            cookies = {
-                'session_token': self.session.cookies.get('__Secure-next-auth.session-token', ''),
-                'cf_clearance': self.session.cookies.get('cf_clearance', '')
-            }
-        else:
-            cookies = {
-                'session_token': self.session.cookies.get('session_token', ''),
-                'cf_clearance': self.session.cookies.get('cf_clearance', '')
-            }
-        
-        self.session_data['cookies'] = cookies
-        self.session_data['last_conversation'] = self.conversation_id
-        with open(SESSION_FILE, 'w') as f:
-            json.dump(self.session_data, f)
-    
-    def get_csrf_token(self):
-        response = self.session.get(f"{DEEPSEEK_URL}/")
-        soup = BeautifulSoup(response.text, 'html.parser')
-        token_tag = soup.find('meta', attrs={'name': 'csrf-token'})
-        return token_tag['content'] if token_tag else ""
-    
-    def login(self):
-        if PLATFORM == "deepseek":
-            platform_name = "DeepSeek Chat"
-            login_url = f"{DEEPSEEK_URL}/auth/signin"
-            domain = ".deepseek.com"
-        elif PLATFORM == "claude":
-            platform_name = "Claude.ai"
-            login_url = f"{CLAUDE_URL}/auth/signin"
-            domain = ".claude.ai"
-        elif PLATFORM == "gemini":
-            platform_name = "Google Gemini"
-            login_url = f"{GEMINI_URL}/auth/signin"
-            domain = ".google.com"
-        else:  # chatgpt
-            platform_name = "ChatGPT"
-            login_url = f"{CHATGPT_URL}/auth/login"
-            domain = ".openai.com"
-            
-        self.print_message(f"🔓 Iniciando sesión en {platform_name}...", 'system')
-        csrf_token = self.get_csrf_token()
-        response = self.session.post(login_url, data={
+    def save_session(self, platform=None):
+        # Sólo se actualizan las credenciales de esta plataforma; las demás se
+        # conservan. Se guardan todas las cookies de su dominio con su nombre real
+        # (ChatGPT usa __Secure-next-auth.session-token, no session_token)
+        platform = platform or PLATFORM
+        domain = PLATFORMS[platform]['domain'].lstrip('.')
+        cookies = {
+            cookie.name: cookie.value
+            for cookie in self.session.cookies
+            if cookie.value and (cookie.domain.lstrip('.') == domain or cookie.domain.endswith('.' + domain))
+        }
+        
+        self.session_writer.mark_dirty({
+            'platform': platform,
+            'cookies': cookies,
+            'last_conversation': self.conversation_id,
+        }, key=platform)
+    
+    def cached_csrf_token(self, platform):
+        cached = json.loads(self.store.get_setting(f"csrf:{platform}") or "{}")
+        if cached.get('token') and cached.get('expires', 0) > time.time():
+            return cached['token']
+        return None
+    
+    def get_csrf_token(self, platform=None):
+        # Token guardado con su caducidad; si no hay, se lee la página en streaming
+        platform = platform or PLATFORM
+        cached = self.cached_csrf_token(platform)
+        if cached:
+            return cached
+        
+        with self.session.get(f"{PLATFORMS[platform]['url']}/", stream=True) as response:
+            token = find_csrf_token(response)
+        if token:
+            self.store.set_setting(f"csrf:{platform}", json.dumps({'token': token, 'expires': time.time() + CSRF_TTL}))
+        return token
+    
+    def post_login(self, login_url, csrf_token):
+        return self.session.post(login_url, data={
             "_token": csrf_token,
             "email": "tu_email@ejemplo.com",  # Reemplazar con tu email
             "password": "tu_password",         # Reemplazar con tu password
             "remember": "on"
         }, allow_redirects=False)
+    
+    def login(self, platform=None, interactive=True):
+        # interactive=False: si falla el login automático se devuelve False en
+        # lugar de pedir las cookies por stdin
+        platform = platform or PLATFORM
+        platform_name = PLATFORMS[platform]["name"]
+        login_url = platform_url(platform, "login_path")
+        domain = PLATFORMS[platform]["domain"]
+        
+        self.print_message(f"🔓 Iniciando sesión en {platform_name}...", 'system')
+        cached = self.cached_csrf_token(platform)
+        response = self.post_login(login_url, self.get_csrf_token(platform))
+        if response.status_code != 302 and cached:
+            # El token guardado suele ir ligado a la sesión caducada: un intento
+            # más con uno recién leído antes de pasar al login manual
+            self.store.set_setting(f"csrf:{platform}", None)
+            response = self.post_login(login_url, self.get_csrf_token(platform))
         
         if response.status_code == 302:
             self.print_message("✅ Sesión iniciada correctamente", 'system')
-            self.save_session()
+            self.save_session(platform)
             return True
         else:
+            self.store.set_setting(f"csrf:{platform}", None)  # Puede que el token ya no valga
+            if not interactive:
+                self.print_message(f"❌ Error en inicio de sesión en {platform_name}", 'error')
+                return False
             self.print_message("❌ Error en inicio de sesión. Por favor inicia sesión manualmente:", 'error')
             self.print_message("1. Abre https://chat.deepseek.com en Chrome/Firefox", 'system')
             self.print_message("2. Inicia sesión con tu cuenta", 'system')
             self.print_message("3. Abre las herramientas de desarrollo (F12)", 'system')
             self.print_message("4. Ve a Application > Cookies y copia los valores de:", 'system')
-            self.print_message("   - session_token", 'system')
+            session_cookie = PLATFORMS[platform]['session_cookie']
+            self.print_message(f"   - {session_cookie}", 'system')
             self.print_message("   - cf_clearance", 'system')
             
             cookies = {}
-            cookies['session_token'] = input(f"{COLORS['yellow']}session_token: {COLORS['reset']}").strip()
+            cookies[session_cookie] = input(f"{COLORS['yellow']}{session_cookie}: {COLORS['reset']}").strip()
             cookies['cf_clearance'] = input(f"{COLORS['yellow']}cf_clearance: {COLORS['reset']}").strip()
             
             for name, value in cookies.items():
-                self.session.cookies.set(name, value, domain='.deepseek.com')
+                self.session.cookies.set(name, value, domain=domain)
+            self.save_session(platform)
             
             return True
     
-    def validate_session(self):
-        if PLATFORM == "deepseek":
-            test_url = f"{DEEPSEEK_URL}/api/v0/models"
-        elif PLATFORM == "claude":
-            test_url = f"{CLAUDE_URL}/api/organizations"
-        elif PLATFORM == "gemini":
-            test_url = f"{GEMINI_URL}/api/auth/session"
-        else:  # chatgpt
-            test_url = f"{CHATGPT_URL}/api/auth/session"
-            
-        response = self.session.get(test_url)
+    def validate_session(self, platform=None):
+        platform = platform or PLATFORM
+        if self.store.validation_fresh(platform):
+            return True
         
+        test_url = platform_url(platform, "validate_path")
+        response = self.session.get(test_url)
         if response.status_code == 200:
+            self.store.save_validation(platform)
+        return self.handle_validation(platform, response.status_code)
+    
+    def handle_validation(self, platform, status_code):
+        # Sólo interpreta el código: quien hizo la comprobación de red guarda la
+        # validación (si se guardara aquí, un 200 sacado de la caché alargaría el TTL)
+        if status_code == 200:
             return True
-        elif response.status_code == 401:
+        elif status_code == 401:
+            self.store.clear_validation(platform)
             self.print_message("⚠️ Sesión expirada. Reautenticando...", 'warning')
-            return self.login()
+            return self.login(platform)
         else:
-            self.print_message(f"❌ Error validando sesión: {response.status_code}", 'error')
+            self.print_message(f"❌ Error validando sesión: {status_code}", 'error')
             return False
     
+    async def prevalidate(self, platform):
+        # Se lanza al arrancar para todas las plataformas mientras el usuario
+        # elige en el menú: resuelve DNS, abre la conexión TLS en el pool de
+        # httpx y valida la sesión. Devuelve el código HTTP o None si falló.
+        if self.store.validation_fresh(platform):
+            return 200
+        try:
+            response = await self.get_async_client(platform).get(platform_url(platform, "validate_path"))
+        except Exception:
+            return None  # Se reintenta en primer plano con validate_session
+        if response.status_code == 200:
+            self.store.save_validation(platform)
+        return response.status_code
+    
     def encode_file(self, file_path):
         if not os.path.exists(file_path):
             self.print_message(f"❌ Archivo no encontrado: {file_path}", 'error')
             return None
         
+        import mimetypes
         file_name = os.path.basename(file_path)
         mime_type, _ = mimetypes.guess_type(file_path)
         
         if not mime_type:
             mime_type = "application/octet-stream"
         
-        with open(file_path, "rb") as file:
-            file_data = base64.b64encode(file.read()).decode("utf-8")
+        # El base64 queda en la caché de disco; 'data' se inserta en streaming
+        digest, data_path = self.attachment_cache.encode(file_path)
         
         return {
             "file_name": file_name,
             "file_type": mime_type,
             "file_size": os.path.getsize(file_path),
-            "data": file_data
+            "sha256": digest,
+            "data_path": data_path
         }
     
-    def send_message(self, message, files=None):
-        if PLATFORM == "deepseek":
-            url = f"{DEEPSEEK_URL}/api/v0/chat/completions"
-        elif PLATFORM == "claude":
-            url = f"{CLAUDE_URL}/api/chat"
-        elif PLATFORM == "gemini":
-            url = f"{GEMINI_URL}/api/generate_content"
-        else:  # chatgpt
-            url = f"{CHATGPT_URL}/backend-api/conversation"
+    def encode_file_parts(self, file_path, max_bytes):
+        # Como encode_file, pero un fichero de texto mayor que max_bytes no se
+        # codifica: se devuelve con sus fragmentos (cortados en fin de línea)
+        # para que send_message lo procese por partes con map_reduce
+        ranges = self.attachment_cache.split(file_path, max_bytes)
+        if not ranges or len(ranges) == 1:
+            attachment = self.encode_file(file_path)
+            return [attachment] if attachment else []
+        
+        return [{
+            "file_name": os.path.basename(file_path),
+            "file_type": "text/plain",
+            "file_size": ranges[-1][1],
+            "path": os.path.abspath(file_path),
+            "ranges": ranges,
+            "sha256": self.attachment_cache.digest(file_path),
+        }]
+    
+    async def attach_paths(self, spec):
+        # /attach con ficheros, directorios o globs: se expande y se codifica en
+        # el pool de hilos; el contenido repetido (mismo sha256) se adjunta una vez
+        files, skipped = await asyncio.to_thread(collect_attach_files, spec)
+        max_bytes = max(1024, context_budget(MODEL) // 2 * BYTES_PER_TOKEN)
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(loop.run_in_executor(self.attach_executor, self.encode_file_parts, path, max_bytes) for path in files),
+            return_exceptions=True
+        )
+        
+        attachments = []
+        seen = {a["sha256"] for a in self.files_to_attach if isinstance(a, dict)}
+        stats = {"files": 0, "parts": 0, "bytes": 0, "duplicates": 0, "large": 0}
+        for path, parts in zip(files, results):
+            if isinstance(parts, Exception):
+                skipped.append((path, str(parts)))
+                continue
+            new_parts = [part for part in parts if part["sha256"] not in seen]
+            if not new_parts:
+                stats["duplicates"] += 1
+                continue
+            for part in new_parts:
+                seen.add(part["sha256"])
+                stats["bytes"] += part["file_size"]
+                stats["large"] += 1 if part.get("ranges") else 0
+                stats["parts"] += len(part.get("ranges") or [part])
+            stats["files"] += 1
+            attachments.extend(new_parts)
+        return attachments, skipped, stats
+    
+    async def prepare_attachments(self, files):
+        # Acepta rutas o adjuntos ya codificados; la codificación va fuera del event loop
+        attachments = []
+        for f in files or []:
+            attachment = f if isinstance(f, dict) else await asyncio.to_thread(self.encode_file, f)
+            if attachment:
+                attachments.append(attachment)
+        return attachments
+    
+    async def iter_json_body(self, payload, attachments):
+        # Serializa el payload con los adjuntos sin cargarlos enteros en memoria:
+        # el base64 no necesita escape JSON, así que se copia tal cual del disco
+        head = json.dumps(payload)
+        yield head[:-1].encode() + b', "files": ['
+        
+        for i, attachment in enumerate(attachments):
+            meta = {k: v for k, v in attachment.items() if k not in ("sha256", "data_path")}
+            meta_json = json.dumps(meta)
+            yield ("," if i else "").encode() + meta_json[:-1].encode() + b', "data": "'
+            with open(attachment["data_path"], "rb") as f:
+                while True:
+                    chunk = f.read(ENCODE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield b'"}'
+        
+        yield b']}'
+    
+    def get_async_client(self, platform=None):
+        # Un cliente por plataforma con su propio pool de conexiones; comparte
+        # headers y cookies con la sesión de requests usada para el login
+        platform = platform or PLATFORM
+        client = self.clients.get(platform)
+        if client is None:
+            import httpx
+            headers = dict(self.session.headers)
+            headers["Referer"] = f"{PLATFORMS[platform]['url']}/"
+            client = httpx.AsyncClient(
+                headers=headers,
+                cookies=self.session.cookies,
+                timeout=httpx.Timeout(60.0, connect=15.0),
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE
+                ),
+            )
+            self.clients[platform] = client
+        return client
+    
+    async def close_clients(self):
+        clients = list(self.clients.values())
+        self.clients = {}
+        for client in clients:
+            await client.aclose()
+    
+    async def stream_message(self, message, files=None, result=None, context=None):
+        # 'result' acumula el texto, el conversation_id y los tiempos del stream;
+        # 'context' son los turnos previos que acompañan al mensaje
+        if result is None:
+            result = StreamResult(PLATFORM, MODEL, self.conversation_id)
+        url = platform_url(result.platform, "chat_path")
         
         # Construir el payload
         payload = {
-            "messages": [{"role": "user", "content": message}],
-            "model": MODEL,
-            "temperature": 0.7,
-            "max_tokens": 4096,
+            "messages": (context or []) + [{"role": "user", "content": message}],
+            "model": result.model,
+            "temperature": TEMPERATURE,
+            "max_tokens": MAX_RESPONSE_TOKENS,
             "stream": True,
-            "conversation_id": self.conversation_id
+            "conversation_id": result.conversation_id
         }
         
         # Adjuntar archivos si existen
-        if files:
-            payload["files"] = [self.encode_file(f) for f in files if self.encode_file(f)]
+        attachments = await self.prepare_attachments(files)
         
+        client = self.get_async_client(result.platform)
+        # Cada petición deja sus tiempos en self.request_stats (/stats)
+        status = "error"
         try:
-            # Iniciar la solicitud de streaming
-            with self.session.post(url, json=payload, stream=True, timeout=60) as response:
-                if response.status_code != 200:
-                    if response.status_code == 401 and self.login():
-                        return self.send_message(message, files)
-                    else:
-                        return f"❌ Error HTTP {response.status_code}: {response.text}", ""
-                
-                full_response = ""
-                self.streaming_active = True
-                self.stop_stream.clear()
+            for attempt in range(2):
+                if attachments:
+                    request = client.stream("POST", url, content=self.iter_json_body(payload, attachments),
+                                            headers={"Content-Type": "application/json"},
+                                            extensions={"trace": result.trace})
+                else:
+                    request = client.stream("POST", url, json=payload, extensions={"trace": result.trace})
                 
-                for line in response.iter_lines():
-                    if self.stop_stream.is_set():
-                        break
+                # Iniciar la solicitud de streaming
+                async with request as response:
+                    if response.status_code == 401:
+                        self.store.clear_validation(result.platform)
+                    if response.status_code == 401 and attempt == 0 and await self.relogin(result.platform):
+                        continue
                     
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith('data:'):
-                            json_str = decoded_line[5:].strip()
-                            
-                            if json_str == "[DONE]":
-                                break
-                            
-                            try:
-                                data = json.loads(json_str)
-                                if 'choices' in data and data['choices']:
-                                    delta = data['choices'][0].get('delta', {})
-                                    content = delta.get('content', '')
-                                    
-                                    if content:
-                                        full_response += content
-                                        self.stream_queue.put(content)
-                                    
-                                    # Actualizar conversation_id
-                                    if 'conversation_id' in data:
-                                        self.conversation_id = data['conversation_id']
-                                        self.save_session()
-                            
-                            except json.JSONDecodeError:
-                                pass
-                
-                self.streaming_active = False
-                return full_response, self.conversation_id
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        raise ChatHTTPError(response.status_code, body.decode('utf-8', errors='replace'))
+                    
+                    done = False
+                    async for event in self.aiter_sse_events(response, result):
+                        # Tras [DONE] se lee el resto del cuerpo sin procesarlo: si se
+                        # sale antes del último chunk, httpx descarta la conexión
+                        if done or event.data == "[DONE]":
+                            done = True
+                            continue
+                        
+                        content = self.process_event(event, result)
+                        if content:
+                            result.add(content)
+                            yield content
+                    status = "ok"
+                    return
+        except (asyncio.CancelledError, GeneratorExit):
+            status = "cancelled"
+            raise
+        finally:
+            self.request_stats.record(result, status)
+    
+    async def relogin(self, platform):
+        # login() bloquea (requests e input()): va en un hilo y con un lock por
+        # plataforma para que varias peticiones con 401 no inicien sesión a la vez
+        count = self.login_count.get(platform, 0)
+        lock = self.login_locks.setdefault(platform, asyncio.Lock())
+        async with lock:
+            if self.login_count.get(platform, 0) != count:
+                return True  # Otra petición ya reautenticó mientras se esperaba
+            if self.prompt_active:
+                # run_in_terminal suspende el prompt mientras se piden las cookies
+                from prompt_toolkit.application import run_in_terminal
+                ok = await run_in_terminal(lambda: self.login(platform), in_executor=True)
+            else:
+                ok = await asyncio.to_thread(self.login, platform, self.interactive)
+            if ok:
+                self.login_count[platform] = count + 1
+            return ok
+    
+    async def aiter_sse_events(self, response, result=None):
+        decoder = SSEDecoder()
+        async for chunk in response.aiter_bytes():
+            if result is not None:
+                result.chunks += 1
+                result.bytes = response.num_bytes_downloaded
+            for event in decoder.feed(chunk):
+                yield event
+        for event in decoder.flush():
+            yield event
+    
+    async def complete(self, prompt, platform, model, progress=None):
+        # Petición auxiliar sin render que devuelve el texto completo; pasa por
+        # la caché de respuestas para no repetir trabajo tras un fallo o Ctrl+C
+        key = None
+        if self.response_cache.enabled:
+            key = self.response_cache.key(platform, model, TEMPERATURE, prompt, [])
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                if progress:
+                    progress['cached'] += 1
+                return "".join(cached)
+        
+        result = StreamResult(platform, model)
+        async for _ in self.stream_message(prompt, result=result):
+            pass
+        result.finish()
+        if key and result.parts:
+            self.response_cache.put(key, result)
+        return result.text
+    
+    def print_progress(self, progress):
+        sys.stdout.write(
+            f"\r{COLORS['cyan']}🧩 {progress['label']}: {progress['done']}/{progress['total']}"
+            f" ({progress['cached']} de caché, {progress['failed']} con error){COLORS['reset']}"
+        )
+        sys.stdout.flush()
+    
+    async def map_reduce(self, message, large, platform, model):
+        # Los textos que no caben en una petición se procesan por fragmentos:
+        # cada uno va en su propia petición (como mucho MAP_REDUCE_CONCURRENCY a
+        # la vez, leyéndolo del disco sólo entonces) y las notas parciales se
+        # combinan por niveles hasta que caben en la petición final.
+        semaphore = asyncio.Semaphore(MAP_REDUCE_CONCURRENCY)
+        progress = {'label': "Fragmentos", 'done': 0, 'total': 0, 'cached': 0, 'failed': 0}
+        
+        async def run_limited(make_prompt):
+            async with semaphore:
+                try:
+                    return await self.complete(await make_prompt(), platform, model, progress)
+                except Exception as e:
+                    progress['failed'] += 1
+                    return e
+                finally:
+                    progress['done'] += 1
+                    self.print_progress(progress)
+        
+        def map_prompt(attachment, part, start, end):
+            async def make():
+                chunk = await asyncio.to_thread(read_text_range, attachment['path'], start, end)
+                return MAP_PROMPT.format(part=part, parts=len(attachment['ranges']),
+                                         file_name=attachment['file_name'], question=message, chunk=chunk)
+            return make
+        
+        jobs = []
+        labels = []
+        for attachment in large:
+            for part, (start, end) in enumerate(attachment['ranges'], 1):
+                jobs.append(map_prompt(attachment, part, start, end))
+                labels.append(f"[{attachment['file_name']} {part}/{len(attachment['ranges'])}]")
+        progress['total'] = len(jobs)
+        self.print_progress(progress)
+        results = await asyncio.gather(*(run_limited(job) for job in jobs))
+        sys.stdout.write("\n")
+        
+        errors = [r for r in results if isinstance(r, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+        notes = [f"{label}\n{text}" for label, text in zip(labels, results) if not isinstance(text, Exception)]
+        
+        # Reducción jerárquica: grupos de notas que caben en media ventana
+        budget = max(1, context_budget(model) // 2)
+        level = 1
+        while len(notes) > 1 and sum(estimate_tokens(note) for note in notes) > budget:
+            groups = [[]]
+            used = 0
+            for note in notes:
+                tokens = estimate_tokens(note)
+                if groups[-1] and used + tokens > budget:
+                    groups.append([])
+                    used = 0
+                groups[-1].append(note)
+                used += tokens
+            if len(groups) == len(notes):
+                break  # Cada nota llena ya media ventana: no se puede combinar más
+            
+            def reduce_prompt(group):
+                async def make():
+                    return REDUCE_PROMPT.format(question=message, notes="\n\n".join(group))
+                return make
+            
+            progress.update(label=f"Combinando notas (nivel {level})", done=0, total=len(groups), cached=0, failed=0)
+            self.print_progress(progress)
+            reduced = await asyncio.gather(*(run_limited(reduce_prompt(group)) for group in groups))
+            sys.stdout.write("\n")
+            # Si falla una combinación se conservan sus notas sin combinar
+            notes = [
+                "\n\n".join(group) if isinstance(text, Exception) else text
+                for group, text in zip(groups, reduced)
+            ]
+            level += 1
         
+        if errors:
+            self.print_message(f"⚠️ {len(errors)} fragmentos sin respuesta: {errors[0]}", 'warning')
+        return "\n\n".join(notes)
+    
+    async def send_message(self, message, files=None):
+        result = StreamResult(PLATFORM, MODEL, self.conversation_id)
+        self.last_result = result
+        context = self.history.context_window(context_budget(MODEL) - estimate_tokens(message))
+        renderer = StreamRenderer(highlighter=CodeHighlighter())
+        self.streaming_active = True
+        try:
+            attachments = await self.prepare_attachments(files)
+            
+            cache_key = None
+            cached = None
+            if self.response_cache.enabled:
+                cache_key = self.response_cache.key(
+                    PLATFORM, MODEL, TEMPERATURE, message, [a["sha256"] for a in attachments], context
+                )
+                cached = self.response_cache.get(cache_key)
+            
+            prompt = message
+            large = [a for a in attachments if a.get("ranges")]
+            if large and cached is None:
+                attachments = [a for a in attachments if not a.get("ranges")]
+                notes = await self.map_reduce(message, large, result.platform, result.model)
+                prompt = FINAL_PROMPT.format(
+                    question=message, files=", ".join(a["file_name"] for a in large), notes=notes
+                )
+                context = self.history.context_window(context_budget(MODEL) - estimate_tokens(prompt))
+            
+            if cached is not None:
+                # Se reproduce por el mismo renderer que una respuesta en vivo
+                result.cached = True
+                for content in cached:
+                    result.add(content)
+                    renderer.write(content)
+                renderer.close()
+                self.print_message("\n♻️ Respuesta recuperada de la caché (/nocache para desactivarla)", 'system')
+            else:
+                with self.session_writer.paused():
+                    async for content in self.stream_message(prompt, attachments, result, context):
+                        renderer.write(content)
+                if cache_key and result.parts:
+                    self.response_cache.put(cache_key, result)
+        except asyncio.CancelledError:
+            result.truncated = True
+            renderer.close()
+            if not self.stream_interrupted:
+                raise  # Cancelación de fuera (/exit, Ctrl+D): no se absorbe
+            self.print_message("\n\n🔴 Generación interrumpida (se guarda la respuesta parcial)\n", 'warning')
+        except ChatHTTPError as e:
+            return f"❌ Error HTTP {e.status_code}: {e.text}", ""
         except Exception as e:
-            self.streaming_active = False
             return f"❌ Excepción: {str(e)}", ""
+        finally:
+            renderer.close()
+            result.finish()
+            self.streaming_active = False
+            if result.parts:
+                self.store.record_timing(self.history.conversation, result)
+            
+            # Actualizar conversation_id
+            if result.conversation_id != self.conversation_id:
+                self.conversation_id = result.conversation_id
+                self.save_session()
+        
+        return result.text, self.conversation_id
+    
+    async def compare(self, message, platforms=None):
+        # Mismo prompt a varias plataformas a la vez, cada una con su pool
+        platforms = platforms or COMPARE_PLATFORMS
+        results = [StreamResult(platform, MODEL) for platform in platforms]
+        renderer = StreamRenderer()
+        self.streaming_active = True
+        try:
+            await asyncio.gather(*(self.compare_one(message, result, renderer) for result in results))
+        except asyncio.CancelledError:
+            renderer.close()
+            if not self.stream_interrupted:
+                raise
+            self.print_message("\n\n🔴 Comparación interrumpida\n", 'warning')
+        finally:
+            renderer.close()
+            self.streaming_active = False
+        
+        self.print_compare_summary(results)
+        return results
+    
+    async def compare_one(self, message, result, renderer):
+        # Las líneas de cada plataforma se pintan completas y con su etiqueta
+        info = PLATFORMS[result.platform]
+        label = f"{COLORS[info['color']]}[{info['name']}]{COLORS['reset']} "
+        pending = ""
+        try:
+            async for content in self.stream_message(message, result=result):
+                pending += content
+                if "\n" in pending:
+                    lines = pending.split("\n")
+                    pending = lines.pop()
+                    renderer.write("".join(f"{label}{line}\n" for line in lines))
+        except ChatHTTPError as e:
+            result.error = f"Error HTTP {e.status_code}"
+        except asyncio.CancelledError:
+            result.error = "interrumpido"
+            raise
+        except Exception as e:
+            result.error = str(e)
+        finally:
+            if pending:
+                renderer.write(f"{label}{pending}\n")
+            result.finish()
+    
+    def print_stats(self):
+        rows = self.request_stats.summary()
+        if not rows:
+            self.print_message("📊 Aún no hay peticiones registradas", 'system')
+            return
+        
+        def seconds(value):
+            return "-" if value is None else f"{value * 1000:.0f} ms"
+        
+        def number(value):
+            return "-" if value is None else f"{value:.0f}"
+        
+        names = {"ok": "correctas", "error": "con error", "cancelled": "interrumpidas"}
+        self.print_message(f"📊 Últimas {len(self.request_stats.samples)} peticiones (p50 / p95):", 'system')
+        for row in rows:
+            statuses = ", ".join(f"{count} {names.get(status, status)}" for status, count in sorted(row['statuses'].items()))
+            print(f"{COLORS['cyan']}{row['platform']}/{row['model']}: {row['count']} peticiones ({statuses}){COLORS['reset']}")
+            for field, label, fmt in (
+                ("connect", "Conexión (DNS+TCP)", seconds), ("tls", "TLS", seconds),
+                ("ttfb", "Primer byte", seconds), ("ttft", "Primer token", seconds),
+                ("duration", "Total", seconds), ("tokens", "Tokens", number),
+                ("bytes", "Bytes", number), ("chunks", "Lecturas", number),
+            ):
+                p50, p95, count = row[field]
+                if count:
+                    extra = f"  ({count} conexiones nuevas)" if field in ("connect", "tls") else ""
+                    print(f"   {label:<20}{fmt(p50):>10} / {fmt(p95):<10}{extra}".rstrip())
+    
+    def print_compare_summary(self, results):
+        self.print_message("\n📊 Comparación:", 'system')
+        self.print_message(f"{'Plataforma':<16}{'TTFT':>9}{'Tokens':>9}{'Tok/s':>9}{'Total':>9}", 'system')
+        for result in results:
+            name = PLATFORMS[result.platform]["name"]
+            if result.error:
+                self.print_message(f"{name:<16} ❌ {result.error}", 'system')
+                continue
+            ttft = f"{result.ttft:.2f}s" if result.ttft is not None else "-"
+            self.print_message(
+                f"{name:<16}{ttft:>9}{result.tokens:>9}"
+                f"{result.tokens_per_second:>9.1f}{result.duration:>8.2f}s",
+                'system'
+            )
+    
+    def load_batch_checkpoint(self, output_path):
+        # El propio JSONL de salida es el checkpoint: lo terminado sin error no se repite
+        done = set()
+        if not os.path.exists(output_path):
+            return done
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Última línea a medias tras una interrupción
+                if not record.get('error'):
+                    done.add(str(record.get('id')))
+        return done
+    
+    async def run_batch(self, input_path, output_path, workers=BATCH_WORKERS,
+                        rate=BATCH_RATE_LIMIT, platform=None):
+        platform = platform or PLATFORM
+        done = self.load_batch_checkpoint(output_path)
+        jobs = asyncio.Queue(maxsize=workers * 2)
+        limiters = {}
+        stats = {'ok': 0, 'error': 0, 'skipped': 0}
+        
+        self.print_message(f"📦 Lote: {input_path} -> {output_path} ({workers} en paralelo)", 'system')
+        started = time.perf_counter()
+        try:
+            with open(output_path, 'a', encoding='utf-8') as out:
+                tasks = [
+                    asyncio.create_task(self.batch_worker(jobs, out, limiters, rate, stats))
+                    for _ in range(workers)
+                ]
+                
+                # Los prompts se leen de forma perezosa; la cola acotada frena la lectura
+                with open(input_path, 'r', encoding='utf-8') as f:
+                    for line_number, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            item = json.loads(line)
+                        except json.JSONDecodeError:
+                            self.print_message(f"❌ Línea {line_number} no es JSON válido", 'error')
+                            continue
+                        
+                        item.setdefault('id', line_number)
+                        item.setdefault('platform', platform)
+                        if str(item['id']) in done:
+                            stats['skipped'] += 1
+                            continue
+                        await jobs.put(item)
+                
+                for _ in tasks:
+                    await jobs.put(None)
+                await asyncio.gather(*tasks)
+        finally:
+            await self.close_clients()
+            self.session_writer.flush()
+        
+        self.print_message(
+            f"🏁 Lote terminado en {time.perf_counter() - started:.1f}s: "
+            f"{stats['ok']} correctos, {stats['error']} con error, {stats['skipped']} ya hechos",
+            'system'
+        )
+    
+    async def batch_worker(self, jobs, out, limiters, rate, stats):
+        while True:
+            item = await jobs.get()
+            if item is None:
+                return
+            
+            platform = item['platform']
+            if platform not in limiters:
+                limiters[platform] = RateLimiter(rate)
+            await limiters[platform].wait()
+            
+            result = StreamResult(platform, item.get('model', MODEL))
+            started_at = time.time()
+            try:
+                if platform not in PLATFORMS:
+                    raise ValueError(f"Plataforma desconocida: {platform}")
+                async for _ in self.stream_message(item['prompt'], item.get('files'), result):
+                    pass
+            except ChatHTTPError as e:
+                result.error = f"Error HTTP {e.status_code}: {e.text[:200]}"
+            except Exception as e:
+                result.error = str(e)
+            finally:
+                result.finish()
+            
+            out.write(json.dumps({
+                "id": item['id'],
+                "platform": platform,
+                "model": result.model,
+                "prompt": item['prompt'],
+                "response": result.text,
+                "conversation_id": result.conversation_id,
+                "error": result.error,
+                "started_at": started_at,
+                "ttft": result.ttft,
+                "duration": result.duration,
+                "tokens": result.tokens,
+                "tokens_per_second": result.tokens_per_second,
+            }, ensure_ascii=False) + "\n")
+            out.flush()
+            
+            if result.error:
+                stats['error'] += 1
+                self.print_message(f"❌ [{item['id']}] {result.error}", 'error')
+            else:
+                stats['ok'] += 1
+                self.print_message(f"✅ [{item['id']}] {result.tokens} tokens en {result.duration:.1f}s", 'system')
+    
+    async def serve_daemon(self, path=None):
+        # Proceso de larga vida con sesiones validadas, pools HTTP abiertos y
+        # lexers ya cargados; consola_cliente.py le habla por un socket Unix
+        # con una petición JSON por conexión y respuestas NDJSON en streaming.
+        path = path or DAEMON_SOCKET
+        if os.path.exists(path):
+            try:
+                _, probe = await asyncio.open_unix_connection(path)
+                probe.close()
+                self.print_message(f"❌ Ya hay un daemon escuchando en {path}", 'error')
+                return
+            except OSError:
+                os.unlink(path)  # Socket huérfano de un daemon anterior
+        
+        for language in DAEMON_WARM_LEXERS:
+            get_cached_lexer(language)
+        get_cached_formatter()
+        
+        server = await asyncio.start_unix_server(self.handle_daemon_client, path=path)
+        os.chmod(path, 0o600)  # Las cookies de sesión sólo para el usuario dueño
+        try:
+            await self.serve_until_stopped(server, f"🛰️ Daemon escuchando en {path}")
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+    
+    async def serve_until_stopped(self, server, banner):
+        # Común a --daemon y --serve: atiende hasta Ctrl+C, SIGTERM o /shutdown
+        self.daemon_stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.daemon_stop.set)
+        
+        self.print_message(f"{banner} (Ctrl+C para detenerlo)", 'system')
+        try:
+            async with server:
+                await self.daemon_stop.wait()
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            await self.close_clients()
+            self.session_writer.flush()
+            self.print_message("👋 Servidor detenido", 'system')
+    
+    async def until_disconnect(self, coro, reader):
+        # Ejecuta 'coro' y lo cancela si el cliente cierra la conexión antes
+        # (Ctrl+C en el cliente): así se corta también la petición al backend
+        task = asyncio.create_task(coro)
+        gone = asyncio.create_task(reader.read())
+        done, _ = await asyncio.wait({task, gone}, return_when=asyncio.FIRST_COMPLETED)
+        if gone in done:
+            task.cancel()
+        gone.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    
+    async def daemon_send(self, writer, data):
+        writer.write(json.dumps(data, ensure_ascii=False).encode('utf-8') + b"\n")
+        await writer.drain()
+    
+    async def handle_daemon_client(self, reader, writer):
+        try:
+            try:
+                request = json.loads(await reader.readline())
+            except (json.JSONDecodeError, ValueError):
+                await self.daemon_send(writer, {"error": "Petición JSON no válida"})
+                return
+            
+            command = request.get('command', 'prompt')
+            if command == 'ping':
+                await self.daemon_send(writer, {"ok": True, "pid": os.getpid(), "platform": PLATFORM, "model": MODEL})
+            elif command == 'shutdown':
+                await self.daemon_send(writer, {"ok": True})
+                self.daemon_stop.set()
+            elif command == 'prompt':
+                await self.until_disconnect(self.daemon_prompt(request, writer), reader)
+            else:
+                await self.daemon_send(writer, {"error": f"Comando desconocido: {command}"})
+        except (ConnectionError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+    
+    async def daemon_prompt(self, request, writer):
+        platform = request.get('platform') or PLATFORM
+        if platform not in PLATFORMS:
+            await self.daemon_send(writer, {"error": f"Plataforma desconocida: {platform}"})
+            return
+        message = request.get('prompt', '')
+        
+        # Cada petición abre conversación nueva salvo que pida continuar la última
+        # del demonio, que se recuerda aparte de la conversación activa del REPL
+        history = ConversationStore(self.store, 'daemon_conversation')
+        if not request.get('continue'):
+            history.conversation = None
+        remote_id = self.store.remote_id(history.conversation) if history.conversation else ""
+        result = StreamResult(platform, request.get('model') or MODEL, remote_id)
+        context = history.context_window(context_budget(result.model) - estimate_tokens(message))
+        highlighter = CodeHighlighter() if request.get('color', True) else None
+        
+        try:
+            async for content in self.stream_message(message, request.get('files'), result, context):
+                await self.daemon_send(writer, {"delta": highlighter.feed(content) if highlighter else content})
+            if highlighter:
+                await self.daemon_send(writer, {"delta": highlighter.finish()})
+        except ChatHTTPError as e:
+            result.error = f"Error HTTP {e.status_code}: {e.text[:200]}"
+        except (ConnectionError, BrokenPipeError, asyncio.CancelledError):
+            # El cliente se fue: lo recibido hasta ahora se guarda como truncado
+            result.truncated = True
+            raise
+        except Exception as e:
+            result.error = str(e)
+        finally:
+            result.finish()
+            if result.parts:
+                history.append_exchange(message, result)
+                self.store.record_timing(history.conversation, result)
+        
+        await self.daemon_send(writer, {
+            "done": True,
+            "error": result.error,
+            "conversation": history.conversation,
+            "conversation_id": result.conversation_id,
+            "tokens": result.tokens,
+            "ttft": result.ttft,
+            "duration": result.duration,
+        })
+    
+    async def serve_api(self, host=API_HOST, port=API_PORT):
+        # Proxy HTTP local con la API de OpenAI (/v1/chat/completions y
+        # /v1/models): todas las herramientas comparten las sesiones ya
+        # validadas y los pools de conexiones de este proceso
+        server = await asyncio.start_server(self.handle_api_client, host, port)
+        await self.serve_until_stopped(server, f"🔌 API compatible con OpenAI en http://{host}:{port}/v1")
+    
+    async def api_send(self, writer, status, data=None, headers=None):
+        reasons = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+                   411: "Length Required", 413: "Payload Too Large", 502: "Bad Gateway"}
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8') if data is not None else b""
+        head = [f"HTTP/1.1 {status} {reasons.get(status, 'Error')}", "Connection: close"]
+        for name, value in (headers or {"Content-Type": "application/json",
+                                        "Content-Length": str(len(body))}).items():
+            head.append(f"{name}: {value}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+    
+    async def api_event(self, writer, data):
+        writer.write(b"data: " + json.dumps(data, ensure_ascii=False).encode('utf-8') + b"\n\n")
+        await writer.drain()
+    
+    async def api_error(self, writer, status, message, kind="invalid_request_error"):
+        await self.api_send(writer, status, {"error": {"message": message, "type": kind}})
+    
+    async def handle_api_client(self, reader, writer):
+        # Una petición por conexión (Connection: close), como el daemon
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1].split("?", 1)[0]
+            length = headers.get("content-length", "")
+            length = int(length) if length.isdigit() else None
+            
+            if path == "/v1/models":
+                models = [f"{platform}/{model}" for platform, config in PLATFORMS.items() for model in config['models']]
+                await self.api_send(writer, 200, {"object": "list", "data": [
+                    {"id": model, "object": "model", "owned_by": model.split("/")[0]} for model in models
+                ]})
+            elif path != "/v1/chat/completions":
+                await self.api_error(writer, 404, f"Ruta desconocida: {path}")
+            elif method != "POST":
+                await self.api_error(writer, 405, "Usa POST")
+            elif "content-length" not in headers:
+                await self.api_error(writer, 411, "Falta Content-Length")
+            elif length is None:
+                await self.api_error(writer, 400, "Content-Length no válido")
+            elif length > API_MAX_BODY_BYTES:
+                await self.api_error(writer, 413, "Cuerpo demasiado grande")
+            else:
+                try:
+                    request = json.loads(await reader.readexactly(length))
+                except (json.JSONDecodeError, ValueError):
+                    await self.api_error(writer, 400, "JSON no válido")
+                    return
+                error = self.api_request_error(request)
+                if error:
+                    await self.api_error(writer, 400, error)
+                    return
+                await self.until_disconnect(self.api_completion(request, writer), reader)
+        except (ConnectionError, BrokenPipeError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    def api_request_error(self, request):
+        # Forma mínima que api_completion da por hecha; None si es válida
+        if not isinstance(request, dict):
+            return "El cuerpo debe ser un objeto JSON"
+        if not isinstance(request.get('model') or "", str):
+            return "'model' debe ser una cadena"
+        messages = request.get('messages')
+        if not isinstance(messages, list) or not messages:
+            return "'messages' debe ser una lista no vacía"
+        for item in messages:
+            if not isinstance(item, dict):
+                return "Cada mensaje debe ser un objeto"
+            if not isinstance(item.get('role', 'user'), str):
+                return "'role' debe ser una cadena"
+            if not isinstance(item.get('content') or "", (str, list)):
+                return "'content' debe ser una cadena o una lista de partes"
+        return None
+    
+    def resolve_model(self, name):
+        # "plataforma/modelo", "plataforma" o "modelo" (en la plataforma por defecto)
+        platform, _, model = (name or "").partition("/")
+        if not model:
+            if platform in PLATFORMS:
+                return platform, MODEL
+            return PLATFORM, platform or MODEL
+        return platform, model
+    
+    async def api_completion(self, request, writer):
+        platform, model = self.resolve_model(request.get('model'))
+        if platform not in PLATFORMS:
+            await self.api_error(writer, 404, f"Plataforma desconocida: {platform}")
+            return
+        
+        # Contenido en texto plano o como lista de partes {"type": "text", ...}
+        messages = []
+        for item in request.get('messages') or []:
+            content = item.get('content') or ""
+            if isinstance(content, list):
+                content = "".join(part.get('text', "") for part in content if isinstance(part, dict))
+            messages.append({"role": item.get('role', 'user'), "content": content})
+        if not messages or messages[-1]['role'] != 'user':
+            await self.api_error(writer, 400, "El último mensaje debe ser del usuario")
+            return
+        
+        message = messages[-1]['content']
+        result = StreamResult(platform, model)
+        completion_id = f"chatcmpl-{os.getpid()}-{id(result):x}"
+        created = int(time.time())
+        
+        def chunk(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": f"{platform}/{model}",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        
+        stream = self.stream_message(message, result=result, context=messages[:-1])
+        try:
+            if request.get('stream'):
+                # Se espera al primer token para que un error HTTP aún pueda ir como JSON
+                first = await anext(stream, None)
+                await self.api_send(writer, 200, headers={"Content-Type": "text/event-stream",
+                                                          "Cache-Control": "no-cache"})
+                await self.api_event(writer, chunk({"role": "assistant", "content": ""}))
+                if first is not None:
+                    await self.api_event(writer, chunk({"content": first}))
+                async for content in stream:
+                    await self.api_event(writer, chunk({"content": content}))
+                await self.api_event(writer, chunk({}, "stop"))
+                writer.write(b"data: [DONE]\n\n")
+                await writer.drain()
+            else:
+                async for _ in stream:
+                    pass
+                prompt_tokens = sum(estimate_tokens(m['content']) for m in messages)
+                await self.api_send(writer, 200, {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": f"{platform}/{model}",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": result.text}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": result.tokens,
+                              "total_tokens": prompt_tokens + result.tokens},
+                })
+        except ChatHTTPError as e:
+            result.error = f"Error HTTP {e.status_code}"
+            if not result.parts:
+                # 401: la sesión caducó y en modo servidor no se puede pedir otra
+                status = 401 if e.status_code == 401 else 502
+                await self.api_error(writer, status, f"{result.error}: {e.text[:200]}", "upstream_error")
+        except (ConnectionError, BrokenPipeError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            result.error = str(e)
+            if not result.parts:
+                await self.api_error(writer, 502, result.error, "upstream_error")
+        finally:
+            await stream.aclose()
+            result.finish()
+            if result.parts:
+                self.store.record_timing(None, result)
+    
+    async def run_streaming(self, coro):
+        # Ctrl+C durante la respuesta cancela la tarea en lugar de matar el loop
+        loop = asyncio.get_running_loop()
+        self.stream_interrupted = False
+        self.stream_task = asyncio.ensure_future(coro)
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.cancel_stream)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: el KeyboardInterrupt llega por la vía normal
+        
+        try:
+            return await self.stream_task
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+            self.stream_task = None
+    
+    def cancel_stream(self):
+        # Sólo esta cancelación (Ctrl+C del usuario) la absorben send_message y
+        # compare; cualquier otra, como la del dispatcher al salir, se propaga
+        if self.stream_task and not self.stream_task.done():
+            self.stream_interrupted = True
+            self.stream_task.cancel()
+    
+    def process_event(self, event, result):
+        try:
+            data = json.loads(event.data)
+        except json.JSONDecodeError:
+            return ""
+        
+        if not isinstance(data, dict):
+            return ""
+        
+        content = ""
+        if 'choices' in data and data['choices']:
+            delta = data['choices'][0].get('delta', {})
+            content = delta.get('content', '')
+            
+            # El conversation_id se aplica y persiste al terminar el stream
+            if 'conversation_id' in data:
+                result.conversation_id = data['conversation_id']
+        
+        return content
     
     def print_message(self, message, message_type='system'):
-        color = COLORS.get(message_type, 'white')
+        color = COLORS.get(message_type, COLORS['white'])
         prefix = ""
         
         if message_type == 'user':
@@ -319,16 +2669,6 @@ class DeepSeekTerminal:
         sys.stdout.write(f"{color}{prefix}{message}{COLORS['reset']}\n")
         sys.stdout.flush()
     
-    def print_stream(self):
-        while self.streaming_active or not self.stream_queue.empty():
-            try:
-                chunk = self.stream_queue.get(timeout=0.1)
-                sys.stdout.write(chunk)
-                sys.stdout.flush()
-                self.stream_queue.task_done()
-            except queue.Empty:
-                pass
-    
     def highlight_code(self, text):
         # Detectar bloques de código
         pattern = r'```(\w+)\n(.*?)```'
@@ -337,17 +2677,17 @@ class DeepSeekTerminal:
             language = match.group(1)
             code = match.group(2)
             
-            try:
-                lexer = get_lexer_by_name(language, stripall=True)
-                formatter = TerminalFormatter()
-                highlighted = highlight(code, lexer, formatter)
-                return highlighted
-            except:
+            lexer = get_cached_lexer(language)
+            if lexer:
+                from pygments import highlight
+                return highlight(code, lexer, get_cached_formatter())
+            else:
                 return f"\n{COLORS['cyan']}```{language}\n{code}```{COLORS['reset']}\n"
         
         return re.sub(pattern, replace_code, text, flags=re.DOTALL)
     
     def choose_platform(self):
+        global PLATFORM
         while True:
             self.print_message("\n" + "="*50, 'system')
             self.print_message(f"🌟 {APP_COMPANY} 🌟", 'brand')
@@ -361,29 +2701,37 @@ class DeepSeekTerminal:
             choice = input(f"{COLORS['yellow']}Selecciona un modelo (1/2/3/4): {COLORS['reset']}").strip()
             
             if choice == "1":
-                global PLATFORM
                 PLATFORM = "deepseek"
                 break
             elif choice == "2":
-                global PLATFORM
                 PLATFORM = "claude"
                 break
             elif choice == "3":
-                global PLATFORM
                 PLATFORM = "gemini"
                 break
             elif choice == "4":
-                global PLATFORM
                 PLATFORM = "chatgpt"
                 break
             else:
                 self.print_message("❌ Opción no válida. Por favor elige 1, 2, 3 o 4.", 'error')
 
     def run(self):
-        self.choose_platform()
+        # Un único event loop gobierna el prompt, la petición, el render y Ctrl+C
+        asyncio.run(self.start())
+    
+    async def start(self):
+        # Las validaciones corren en el loop mientras el menú espera en otro hilo
+        checks = {platform: asyncio.create_task(self.prevalidate(platform)) for platform in PLATFORMS}
+        await asyncio.to_thread(self.choose_platform)
         
-        if not self.validate_session():
+        status = await checks[PLATFORM]
+        if status is None:
+            valid = await asyncio.to_thread(self.validate_session)
+        else:
+            valid = await asyncio.to_thread(self.handle_validation, PLATFORM, status)
+        if not valid:
             self.print_message("❌ No se pudo validar la sesión. Saliendo.", 'error')
+            await self.close_clients()
             return
         
         self.save_session()
@@ -397,90 +2745,303 @@ class DeepSeekTerminal:
         self.print_message("Comandos disponibles:", 'system')
         self.print_message("  /reset  - Reiniciar conversación", 'system')
         self.print_message("  /model  - Cambiar modelo (deepseek-chat, deepseek-coder)", 'system')
-        self.print_message("  /attach - Adjuntar archivo como contexto", 'system')
+        self.print_message("  /attach - Adjuntar archivos, directorios o globs como contexto", 'system')
+        self.print_message("  /compare [@p1,p2] - Enviar a varias plataformas en paralelo", 'system')
+        self.print_message("  /cache  - Estadísticas de la caché de respuestas (/cache clear la vacía)", 'system')
+        self.print_message("  /nocache - Activar/desactivar la caché de respuestas", 'system')
+        self.print_message("  /stats  - Tiempos p50/p95 por plataforma y modelo (/stats export [ruta])", 'system')
+        self.print_message("  /conversations - Listar las conversaciones guardadas", 'system')
+        self.print_message("  /search <texto> - Buscar en conversaciones anteriores", 'system')
         self.print_message("  /exit   - Salir del programa", 'system')
-        self.print_message("  Ctrl+C  - Interrumpir generación\n", 'system')
+        self.print_message("  & texto - Enviar en paralelo en una conversación aparte", 'system')
+        self.print_message("  Ctrl+C  - Interrumpir generación (lo que escribas mientras tanto queda en cola)\n", 'system')
         self.print_message("Soporte técnico: soporte@papiweb.com\n", 'system')
         
-        while True:
+        await self.chat_loop()
+    
+    async def chat_loop(self):
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.styles import Style
+        prompt_session = PromptSession(
+            history=bounded_file_history_class()(HISTORY_FILE),
+            key_bindings=self.create_key_bindings(),
+            style=Style.from_dict(PROMPT_STYLE)
+        )
+        try:
+            await self.prompt_loop(prompt_session)
+        finally:
+            await self.close_clients()
+            self.session_writer.flush()
+    
+    async def prompt_loop(self, prompt_session):
+        # El prompt no se bloquea mientras llega una respuesta: lo que se
+        # escribe entra en una cola que dispatch_loop atiende en orden.
+        # Con patch_stdout la salida se pinta por encima de la línea en edición.
+        from prompt_toolkit.patch_stdout import patch_stdout
+        from prompt_toolkit.formatted_text import ANSI
+        queue = asyncio.Queue()
+        detached = set()
+        with patch_stdout(raw=True):
+            dispatcher = asyncio.create_task(self.dispatch_loop(queue))
+            self.prompt_active = True
             try:
-                user_input = prompt(
-                    f"{COLORS['blue']}👤 Tú:{COLORS['reset']} ",
-                    history=FileHistory(HISTORY_FILE),
-                    key_bindings=self.key_bindings,
-                    multiline=False
-                ).strip()
-                
-                if not user_input:
-                    continue
-                
-                # Comandos especiales
-                if user_input.startswith('/'):
-                    if user_input == '/reset':
-                        self.conversation_id = ""
-                        self.message_history = []
-                        self.print_message("🔄 Conversación reiniciada", 'system')
-                        continue
-                    elif user_input.startswith('/model '):
-                        new_model = user_input.split(' ', 1)[1]
-                        MODEL = new_model
-                        self.print_message(f"🔄 Modelo cambiado a: {MODEL}", 'system')
+                while not dispatcher.done():
+                    try:
+                        user_input = (await prompt_session.prompt_async(
+                            ANSI(f"{COLORS['blue']}👤 Tú:{COLORS['reset']} "),
+                            multiline=False
+                        )).strip()
+                    except KeyboardInterrupt:
                         continue
-                    elif user_input.startswith('/attach '):
-                        file_path = user_input.split(' ', 1)[1]
-                        if os.path.exists(file_path):
-                            self.print_message(f"📎 Archivo adjuntado: {file_path}", 'system')
-                            # Guardar para enviar en el próximo mensaje
-                            files_to_attach = [file_path]
-                        else:
-                            self.print_message(f"❌ Archivo no encontrado: {file_path}", 'error')
+                    except EOFError:
+                        self.print_message("\n👋 Sesión finalizada", 'system')
+                        break
+                    
+                    if not user_input:
                         continue
-                    elif user_input == '/exit':
+                    if user_input == '/exit':
                         break
-                
-                # Manejar archivos adjuntos
-                files_to_attach = []
-                
-                self.print_message("", 'assistant')  # Nueva línea para la respuesta
-                
-                # Iniciar hilo para mostrar el stream
-                self.stream_queue = queue.Queue()
-                stream_thread = threading.Thread(target=self.print_stream, daemon=True)
-                stream_thread.start()
-                
-                # Enviar mensaje
-                full_response, conv_id = self.send_message(user_input, files_to_attach)
-                
-                # Esperar a que termine el stream
-                while self.streaming_active:
-                    time.sleep(0.1)
-                
-                # Procesar respuesta completa
-                if full_response and not full_response.startswith('❌'):
-                    # Guardar en historial
-                    self.message_history.append({"role": "user", "content": user_input})
-                    self.message_history.append({"role": "assistant", "content": full_response})
+                    if user_input.startswith('& ') and user_input[2:].strip():
+                        # Prompt independiente: va en paralelo y en su propia conversación
+                        task = asyncio.create_task(self.send_detached(user_input[2:].strip(), len(detached) + 1))
+                        detached.add(task)
+                        task.add_done_callback(detached.discard)
+                        continue
                     
-                    # Mostrar respuesta formateada
-                    self.print_message("\n\n💎 Respuesta formateada:", 'system')
-                    formatted_response = self.highlight_code(full_response)
-                    sys.stdout.write(formatted_response)
-                    sys.stdout.write("\n\n")
-                    sys.stdout.flush()
-                
-                files_to_attach = []  # Resetear archivos adjuntos
-            
-            except KeyboardInterrupt:
-                self.stop_stream.set()
-                self.print_message("\n🔁 Comando interrumpido", 'warning')
-                continue
-            except EOFError:
-                self.print_message("\n👋 Sesión finalizada", 'system')
-                break
+                    if self.streaming_active or queue.qsize():
+                        self.print_message(f"⏳ En cola ({queue.qsize() + 1}): {user_input[:60]}", 'system')
+                    queue.put_nowait(user_input)
+            finally:
+                self.prompt_active = False
+                dispatcher.cancel()
+                for task in detached:
+                    task.cancel()
+                await asyncio.gather(dispatcher, *detached, return_exceptions=True)
+    
+    async def dispatch_loop(self, queue):
+        while True:
+            user_input = await queue.get()
+            try:
+                await self.handle_input(user_input)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.print_message(f"❌ Error: {str(e)}", 'error')
-                continue
+    
+    async def send_detached(self, message, number):
+        # Sin stream en pantalla (se mezclaría con el principal): la respuesta
+        # se muestra completa y coloreada al terminar
+        label = f"[&{number}]"
+        history = ConversationStore(self.store, None)
+        result = StreamResult(PLATFORM, MODEL)
+        self.print_message(f"🔀 {label} Enviado en paralelo: {message[:60]}", 'system')
+        try:
+            async for _ in self.stream_message(message, result=result):
+                pass
+        except ChatHTTPError as e:
+            result.error = f"Error HTTP {e.status_code}: {e.text[:200]}"
+        except asyncio.CancelledError:
+            result.truncated = True
+            raise
+        except Exception as e:
+            result.error = str(e)
+        finally:
+            result.finish()
+            if result.parts:
+                history.append_exchange(message, result)
+                self.store.record_timing(history.conversation, result)
+        
+        if not result.parts:
+            self.print_message(f"{label} {result.error or 'Respuesta vacía'}", 'error')
+            return
+        self.print_message(f"\n🔀 {label} {message[:60]} (conversación #{history.conversation})", 'system')
+        sys.stdout.write(self.highlight_code(result.text) + "\n\n")
+        sys.stdout.flush()
+    
+    async def handle_input(self, user_input):
+        global MODEL
+        # Comandos especiales
+        if user_input.startswith('/'):
+            if user_input == '/reset':
+                self.conversation_id = ""
+                self.history.reset()
+                self.print_message("🔄 Conversación reiniciada", 'system')
+                return
+            elif user_input.startswith('/model '):
+                new_model = user_input.split(' ', 1)[1]
+                MODEL = new_model
+                self.print_message(f"🔄 Modelo cambiado a: {MODEL}", 'system')
+                return
+            elif user_input.startswith('/attach '):
+                # /attach ruta | directorio | 'src/**/*.py' ...
+                started = time.perf_counter()
+                attachments, skipped, stats = await self.attach_paths(user_input.split(' ', 1)[1])
+                for path, reason in skipped[:10]:
+                    self.print_message(f"⏭️ Omitido {path}: {reason}", 'warning')
+                if len(skipped) > 10:
+                    self.print_message(f"⏭️ ... y {len(skipped) - 10} omitidos más", 'warning')
+                if attachments:
+                    # Guardar para enviar en el próximo mensaje
+                    self.files_to_attach.extend(attachments)
+                    extra = ""
+                    if stats['large']:
+                        extra = f", {stats['large']} por fragmentos: {stats['parts']} partes"
+
+                    self.print_message(
+                        f"📎 {stats['files']} archivos adjuntados ({stats['bytes'] / 1024:.0f} KiB{extra}) "
+                        f"en {(time.perf_counter() - started) * 1000:.0f} ms", 'system'
+                    )
+                elif stats['duplicates']:
+                    self.print_message("📎 Esos archivos ya estaban adjuntados", 'system')
+                elif not skipped:
+                    self.print_message("❌ Ningún archivo coincide", 'error')
+                return
+            elif user_input.startswith('/compare '):
+                # /compare [@deepseek,claude] mensaje
+                message = user_input.split(' ', 1)[1].strip()
+                platforms = None
+                if message.startswith('@'):
+                    targets, _, message = message[1:].partition(' ')
+                    platforms = [p for p in targets.split(',') if p in PLATFORMS]
+                if message:
+                    await self.run_streaming(self.compare(message.strip(), platforms))
+                return
+            elif user_input == '/nocache':
+                self.response_cache.enabled = not self.response_cache.enabled
+                state = "desactivada" if not self.response_cache.enabled else "activada"
+                self.print_message(f"♻️ Caché de respuestas {state}", 'system')
+                return
+            elif user_input.startswith('/cache'):
+                if user_input == '/cache clear':
+                    self.response_cache.store.clear()
+                    self.print_message("🧹 Caché de respuestas vaciada", 'system')
+                    return
+                stats = self.response_cache.stats()
+                self.print_message(
+                    f"♻️ Caché: {stats['hits']} aciertos, {stats['misses']} fallos "
+                    f"({stats['hit_rate']:.0%}), {stats['entries']} entradas, "
+                    f"{stats['bytes'] / 1024:.0f} KiB", 'system'
+                )
+                return
+            elif user_input.startswith('/stats'):
+                if user_input.startswith('/stats export'):
+                    path = user_input[len('/stats export'):].strip() or STATS_EXPORT_FILE
+                    try:
+                        count = self.request_stats.export(path)
+                    except OSError as e:
+                        self.print_message(f"❌ No se pudo exportar: {e}", 'error')
+                    else:
+                        self.print_message(f"💾 {count} peticiones exportadas a {path}", 'system')
+                    return
+                self.print_stats()
+                return
+            elif user_input == '/conversations':
+                rows = self.store.list_conversations()
+                if not rows:
+                    self.print_message("📭 No hay conversaciones guardadas", 'system')
+                for conv, platform, model, title, updated_at, count in rows:
+                    marker = "▶" if conv == self.history.conversation else " "
+                    when = datetime.datetime.fromtimestamp(updated_at).strftime('%Y-%m-%d %H:%M')
+                    self.print_message(
+                        f"{marker} #{conv} {when} [{platform}/{model}] {count} mensajes - {title}", 'system'
+                    )
+                return
+            elif user_input.startswith('/search '):
+                query = user_input.split(' ', 1)[1]
+                started = time.perf_counter()
+                rows = self.store.search(query, mark=(COLORS['yellow'], COLORS['reset']))
+                elapsed = (time.perf_counter() - started) * 1000
+                if not self.store.search_enabled:
+                    self.print_message("❌ Este SQLite no incluye FTS5; búsqueda no disponible", 'error')
+                elif not rows:
+                    self.print_message(f"🔍 Sin resultados para: {query}", 'system')
+                else:
+                    self.print_message(f"🔍 {len(rows)} resultados ({elapsed:.1f} ms):", 'system')
+                for conv, title, role, truncated, created_at, snippet in rows:
+                    when = datetime.datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M')
+                    role = f"{role} (truncada)" if truncated else role
+                    print(f"{COLORS['cyan']}#{conv} {when} {role} - {title}{COLORS['reset']}")
+                    print("   " + " ".join(snippet.split()))
+                return
+        
+        # Manejar archivos adjuntos
+        files_to_attach = self.files_to_attach
+        self.files_to_attach = []
+        
+        self.print_message("", 'assistant')  # Nueva línea para la respuesta
+        
+        # Enviar mensaje; los tokens se pintan a medida que llegan
+        full_response, _ = await self.run_streaming(self.send_message(user_input, files_to_attach))
+        
+        # Procesar respuesta completa
+        if full_response.startswith('❌'):
+            self.print_message(full_response, 'error')
+        elif full_response:
+            # Guardar en historial (marcada como truncada si se interrumpió)
+            self.history.append_exchange(user_input, self.last_result)
+            
+            # La respuesta ya se mostró coloreada durante el stream
+            sys.stdout.write("\n\n")
+            sys.stdout.flush()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"{APP_NAME} - {APP_COMPANY}")
+    parser.add_argument("--batch", metavar="PROMPTS_JSONL",
+                        help="Ejecutar sin interacción los prompts de un JSONL ({\"id\", \"prompt\", ...} por línea)")
+    parser.add_argument("--output", metavar="RESULTADOS_JSONL",
+                        help="Salida del lote; también sirve de checkpoint para reanudar")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS,
+                        help=f"Prompts en paralelo en modo lote (por defecto {BATCH_WORKERS})")
+    parser.add_argument("--rate", type=float, default=BATCH_RATE_LIMIT,
+                        help="Peticiones por segundo y plataforma en modo lote (0 = sin límite)")
+    parser.add_argument("--platform", choices=list(PLATFORMS), default=PLATFORM,
+                        help="Plataforma por defecto de los prompts del lote y del daemon")
+    parser.add_argument("--daemon", action="store_true",
+                        help=f"Quedarse en segundo plano atendiendo a consola_cliente.py en {DAEMON_SOCKET}")
+    parser.add_argument("--socket", metavar="RUTA", default=DAEMON_SOCKET,
+                        help="Socket Unix del daemon")
+    parser.add_argument("--serve", metavar="PUERTO", type=int, nargs="?", const=API_PORT,
+                        help=f"Servir una API compatible con OpenAI en {API_HOST} (por defecto puerto {API_PORT})")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Mostrar el desglose de tiempos de import del arranque")
+    parser.add_argument("--check-startup", metavar="MS", type=float, nargs="?", const=STARTUP_BUDGET_MS,
+                        help=f"Salir con código 1 si el arranque supera MS ms (por defecto {STARTUP_BUDGET_MS})")
+    parser.add_argument("--stats-export", metavar="RUTA",
+                        help=f"Volcar los tiempos de cada petición a RUTA (JSON lines, o Prometheus si acaba en .prom) "
+                             f"cada {STATS_EXPORT_INTERVAL:.0f}s como mucho y al salir")
+    parser.add_argument("--base-url", metavar="URL",
+                        help="Usar un único servidor para todas las plataformas (p.ej. mock_chat_server.py)")
+    args = parser.parse_args()
+    
+    if args.profile_startup:
+        profile_startup()
+        sys.exit(0)
+    if args.check_startup is not None:
+        sys.exit(check_startup(args.check_startup))
+    
+    if args.base_url:
+        use_base_url(args.base_url)
+    
     terminal = DeepSeekTerminal()
-    terminal.run()
\ No newline at end of file
+    if args.stats_export:
+        terminal.request_stats.export_path = args.stats_export
+        atexit.register(terminal.request_stats.export)
+    if args.daemon or args.serve is not None:
+        PLATFORM = args.platform
+        if not terminal.validate_session():
+            terminal.print_message("❌ No se pudo validar la sesión. Saliendo.", 'error')
+            sys.exit(1)
+        # Sin nadie delante: una sesión caducada da 401 en lugar de esperar en stdin
+        terminal.interactive = False
+        if args.serve is not None:
+            asyncio.run(terminal.serve_api(API_HOST, args.serve))
+        else:
+            asyncio.run(terminal.serve_daemon(args.socket))
+    elif args.batch:
+        output = args.output or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+        try:
+            asyncio.run(terminal.run_batch(args.batch, output, max(1, args.workers), args.rate, args.platform))
+        except KeyboardInterrupt:
+            terminal.print_message("\n⏸️ Lote interrumpido; vuelve a lanzarlo para reanudar", 'warning')
+    else:
+        terminal.run()
\ No newline at end of file
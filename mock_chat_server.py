@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# mock_chat_server.py
+# Backend local que imita las cuatro plataformas de consolaavanzadacon_deepseek.py
+# para medir y probar el pipeline de streaming sin red.
+#
+#   python mock_chat_server.py --port 8001 --token-rate 200 --latency 0.3
+#   python consolaavanzadacon_deepseek.py --base-url http://127.0.0.1:8001
+
+import argparse
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+
+PORT = 8001
+
+# Rutas de chat y de validación de sesión de cada plataforma
+CHAT_PATHS = {
+    "/api/v0/chat/completions": "deepseek",
+    "/api/chat": "claude",
+    "/api/generate_content": "gemini",
+    "/backend-api/conversation": "chatgpt",
+}
+VALIDATE_PATHS = {
+    "/api/v0/models": {"data": [{"id": "deepseek-chat"}, {"id": "deepseek-coder"}]},
+    "/api/organizations": [{"uuid": "mock-org", "name": "Mock"}],
+    "/api/auth/session": {"user": {"name": "mock"}, "expires": "2099-01-01T00:00:00Z"},
+}
+LOGIN_PATHS = ("/auth/signin", "/auth/login")
+
+WORDS = (
+    "el la de que en un para con por los streaming token respuesta modelo "
+    "terminal rendimiento latencia servidor cliente buffer evento datos "
+    "conexión sesión caché función bloque código prueba medida"
+).split()
+
+CODE_BLOCK = [
+    "```python\n",
+    "def fibonacci(n):\n",
+    "    a, b = 0, 1\n",
+    "    for _ in range(n):\n",
+    "        a, b = b, a + b\n",
+    "    return a\n",
+    "```\n",
+]
+
+
+class MockConfig:
+    def __init__(self, token_rate=100.0, chunk_size=1, frames_per_write=1, tokens=400,
+                 latency=0.0, error_rate=0.0, drop_rate=0.0, keepalive=0.0,
+                 code_every=120, seed=1234, require_cookie=None, recording=None):
+        self.token_rate = token_rate        # tokens por segundo (0 = sin pausa)
+        self.chunk_size = chunk_size        # tokens por evento 'data:'
+        self.frames_per_write = frames_per_write  # eventos SSE por escritura al socket
+        self.tokens = tokens                # longitud de cada respuesta
+        self.latency = latency              # segundos antes del primer byte
+        self.error_rate = error_rate        # probabilidad de responder HTTP 500
+        self.drop_rate = drop_rate          # probabilidad de cortar a mitad del stream
+        self.keepalive = keepalive          # cada cuántos segundos enviar ': ping'
+        self.code_every = code_every        # cada cuántos tokens insertar un bloque de código
+        self.seed = seed
+        self.require_cookie = require_cookie  # session_token exigido (None = no se valida)
+        self.recording = recording          # bytes SSE grabados que se reproducen tal cual
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def next_random(self):
+        # Cada petición tiene su propio generador: misma semilla, misma secuencia
+        with self.lock:
+            self.requests += 1
+            return random.Random(self.seed * 1000003 + self.requests)
+
+
+def generate_tokens(rng, count, code_every):
+    tokens = []
+    while len(tokens) < count:
+        if code_every and tokens and len(tokens) % code_every == 0:
+            tokens.append("\n\n")
+            tokens.extend(CODE_BLOCK)
+            tokens.append("\n")
+            continue
+        tokens.append(rng.choice(WORDS) + " ")
+    return tokens[:count]
+
+
+class MockChatHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockChat/1.0"
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, extra_headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            return bytes(body)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length)
+
+    def authorized(self):
+        expected = self.config.require_cookie
+        if expected is None:
+            return True
+        return f"session_token={expected}" in self.headers.get("Cookie", "")
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path in VALIDATE_PATHS:
+            if not self.authorized():
+                self.send_json(401, {"error": "unauthorized"})
+            else:
+                self.send_json(200, VALIDATE_PATHS[path])
+        elif path == "/":
+            body = (
+                '<!DOCTYPE html><html><head><meta charset="utf-8">'
+                '<meta name="csrf-token" content="mock-csrf-token">'
+                '<title>Mock Chat</title></head><body>'
+                + "<p>relleno</p>" * 5000 + "</body></html>"
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        body = self.read_body()
+
+        if path in LOGIN_PATHS:
+            token = self.config.require_cookie or "mock-session"
+            self.send_response(302)
+            self.send_header("Location", "/")
+            self.send_header("Set-Cookie", f"session_token={token}; Path=/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if path not in CHAT_PATHS:
+            self.send_json(404, {"error": "not found"})
+            return
+        if not self.authorized():
+            self.send_json(401, {"error": "unauthorized"})
+            return
+
+        try:
+            payload = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            self.send_json(400, {"error": "invalid json"})
+            return
+        self.stream_answer(CHAT_PATHS[path], payload)
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def stream_answer(self, platform, payload):
+        config = self.config
+        rng = config.next_random()
+        if config.latency:
+            time.sleep(config.latency)
+
+        if rng.random() < config.error_rate:
+            self.send_json(500, {"error": "error inyectado"})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        if config.recording is not None:
+            self.replay_recording()
+            return
+
+        conversation_id = payload.get("conversation_id") or f"mock-{platform}-{config.requests}"
+        tokens = generate_tokens(rng, config.tokens, config.code_every)
+        drop_at = rng.randrange(len(tokens)) if tokens and rng.random() < config.drop_rate else None
+        interval = config.chunk_size / config.token_rate if config.token_rate else 0.0
+
+        frames = []
+        started = time.perf_counter()
+        last_ping = started
+        for i in range(0, len(tokens), config.chunk_size):
+            if drop_at is not None and i >= drop_at:
+                self.close_connection = True
+                return  # Corte brusco: sin chunk final
+
+            content = "".join(tokens[i:i + config.chunk_size])
+            event = {
+                "id": f"chatcmpl-{i}",
+                "choices": [{"index": 0, "delta": {"content": content}}],
+                "conversation_id": conversation_id,
+            }
+            frames.append(b"data: " + json.dumps(event).encode() + b"\n\n")
+
+            now = time.perf_counter()
+            if config.keepalive and now - last_ping >= config.keepalive:
+                frames.append(b": ping\n\n")
+                last_ping = now
+
+            if len(frames) >= config.frames_per_write:
+                self.write_chunk(b"".join(frames))
+                frames = []
+
+            # Ritmo fijo respecto al inicio para no acumular deriva
+            if interval:
+                delay = started + (i // config.chunk_size + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        frames.append(b"data: [DONE]\n\n")
+        self.write_chunk(b"".join(frames))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+    def replay_recording(self):
+        # Se reparte la grabación en escrituras de ~1 evento al ritmo configurado
+        config = self.config
+        frames = config.recording.split(b"\n\n")
+        interval = 1.0 / config.token_rate if config.token_rate else 0.0
+        started = time.perf_counter()
+        for i, frame in enumerate(frames):
+            if not frame.strip():
+                continue
+            self.write_chunk(frame + b"\n\n")
+            if interval:
+                delay = started + (i + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockChatServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_server(config=None, host="127.0.0.1", port=0):
+    # Arranca el servidor en un hilo y lo devuelve (port=0 elige un puerto libre)
+    handler = type("Handler", (MockChatHandler,), {"config": config or MockConfig()})
+    httpd = MockChatServer((host, port), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backend SSE local para pruebas y benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--token-rate", type=float, default=100.0, help="Tokens por segundo (0 = sin pausa)")
+    parser.add_argument("--chunk-size", type=int, default=1, help="Tokens por evento 'data:'")
+    parser.add_argument("--frames-per-write", type=int, default=1, help="Eventos SSE por escritura al socket")
+    parser.add_argument("--tokens", type=int, default=400, help="Tokens por respuesta")
+    parser.add_argument("--latency", type=float, default=0.0, help="Segundos hasta el primer byte")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de HTTP 500")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Probabilidad de cortar el stream")
+    parser.add_argument("--keepalive", type=float, default=0.0, help="Intervalo de comentarios ': ping'")
+    parser.add_argument("--code-every", type=int, default=120, help="Tokens entre bloques de código (0 = nunca)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--require-cookie", metavar="TOKEN",
+                        help="Exigir la cookie session_token=TOKEN (401 si falta)")
+    parser.add_argument("--replay", metavar="FICHERO_SSE",
+                        help="Reproducir un stream SSE grabado en lugar de generar tokens")
+    args = parser.parse_args()
+
+    recording = None
+    if args.replay:
+        with open(args.replay, "rb") as f:
+            recording = f.read()
+
+    config = MockConfig(
+        token_rate=args.token_rate,
+        chunk_size=max(1, args.chunk_size),
+        frames_per_write=max(1, args.frames_per_write),
+        tokens=args.tokens,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate,
+        keepalive=args.keepalive,
+        code_every=args.code_every,
+        seed=args.seed,
+        require_cookie=args.require_cookie,
+        recording=recording,
+    )
+    MockChatHandler.config = config
+
+    with MockChatServer((args.host, args.port), MockChatHandler) as httpd:
+        print(f"Servidor mock iniciado en el puerto {args.port}")
+        print(f"Usa: python consolaavanzadacon_deepseek.py --base-url http://{args.host}:{args.port}")
+        httpd.serve_forever()